@@ -0,0 +1,307 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+KINDS = ["posts", "pages", "media", "categories", "tags"]
+TERM_KINDS = ["categories", "tags"]
+BATCH_MAX_ITEMS = 25
+# the attachments controller sets allow_batch = false
+UNBATCHABLE_KINDS = ["media"]
+# fields WordPress types as "string or {raw: string}"
+TEXT_FIELDS = ["title", "content", "excerpt", "caption", "description"]
+# orderby values accepted here, and WordPress's defaults: posts newest first, terms by name
+ORDER_KEYS = {"id": "id", "date": "date", "modified": "modified", "slug": "slug", "name": "name",
+              "title": "title"}
+DEFAULT_ORDER = {"posts": ("date", "desc"), "pages": ("date", "desc"), "media": ("date", "desc"),
+                 "categories": ("name", "asc"), "tags": ("name", "asc")}
+
+class FakeWordPress:
+    # in-memory stand-in for the parts of wp-json that wpapi uses: posts, pages, media (with file
+    # bodies served from /files/ with Range support), categories, tags, batch/v1, pagination headers,
+    # _fields, slug / status / modified_after filters, orderby / order (defaulting like WordPress),
+    # ETag revalidation and If-Range on files. Writes are validated as WordPress would for the text
+    # fields and batchable routes. latency (seconds) is added to every request; error_rate is the
+    # fraction of requests answered with a 503 (Retry-After: 0)
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.items = {kind: {} for kind in KINDS}
+        self.files = {}
+        self.next_id = 1
+        self.clock = 0
+        # one lock for data and stats; writes and listings hold it so handler threads see consistent state
+        self.lock = threading.RLock()
+        self.server = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"requests": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0, "by_endpoint": {}}
+
+    def _timestamp(self):
+        # strictly increasing, so modified_after and orderby=modified behave
+        self.clock += 1
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(1577836800 + self.clock))
+
+    def add(self, kind, data):
+        with self.lock:
+            item_id = self.next_id
+            self.next_id += 1
+            now = self._timestamp()
+        item = {"id": item_id, "slug": data.get("slug") or f"{kind}-{item_id}", "status": "publish",
+                "date": now, "date_gmt": now, "modified": now, "modified_gmt": now, "author": 1, "type": kind}
+        item.update(data)
+        if kind in TERM_KINDS:
+            item.pop("status")
+            item.setdefault("name", item["slug"])
+            item.setdefault("description", "")
+            item["slug"] = item["name"].lower().replace(" ", "-")
+        elif kind == "media":
+            item["status"] = "inherit"
+        for field in TEXT_FIELDS:
+            if isinstance(item.get(field), dict):
+                item[field] = item[field]["raw"]
+            if isinstance(item.get(field), str):
+                item[field] = {"raw": item[field], "rendered": item[field]}
+        self.items[kind][item_id] = item
+        return item
+
+    def add_file(self, name, content, **data):
+        self.files[name] = content
+        data.setdefault("slug", name.rsplit(".", 1)[0])
+        return self.add("media", dict(data, source_url=f"{self.host}/files/{name}", mime_type="image/png",
+                                      media_details={"file": name, "filesize": len(content)}))
+
+    def update(self, kind, item_id, data):
+        item = self.items[kind][item_id]
+        for (field, value) in data.items():
+            if isinstance(value, dict) and field in TEXT_FIELDS:
+                value = value["raw"]
+            if isinstance(item.get(field), dict) and "raw" in item[field]:
+                value = {"raw": value, "rendered": value}
+            item[field] = value
+        with self.lock:
+            item["modified"] = item["modified_gmt"] = self._timestamp()
+        return item
+
+    def list(self, kind, query):
+        with self.lock:
+            return self._list(kind, query)
+
+    def _list(self, kind, query):
+        items = self.items[kind].values()
+        slugs = [slug for value in query.get("slug", []) + query.get("slug[]", []) for slug in value.split(",")]
+        if slugs:
+            slugs = set(slugs)
+            items = [item for item in items if item["slug"] in slugs]
+        if "status" in query:
+            statuses = set(query["status"][0].split(","))
+            items = [item for item in items if item.get("status") in statuses]
+        elif kind in ("posts", "pages"):
+            items = [item for item in items if item["status"] == "publish"]
+        if "modified_after" in query:
+            items = [item for item in items if item["modified"] > query["modified_after"][0]]
+        orderby, order = DEFAULT_ORDER[kind]
+        orderby = query.get("orderby", [orderby])[0]
+        order = query.get("order", [order])[0]
+        key = ORDER_KEYS.get(orderby, orderby)
+        # ties (e.g. posts sharing a date) fall back to id, in the same direction
+        return sorted(items, key=lambda item: (_sort_value(item.get(key)), item["id"]), reverse=order == "desc")
+
+    def write(self, path, body, filename=None, content=None):
+        # returns (status, body) for a create / update, as the endpoint or a batch/v1 sub-request would
+        with self.lock:
+            return self._write(path, body, filename, content)
+
+    def _write(self, path, body, filename, content):
+        m = re.match(r"wp/v2/(\w+)(?:/(\d+))?$", path)
+        if m is None or m.group(1) not in self.items:
+            return 404, {"code": "rest_no_route", "message": "No route was found"}
+        kind, item_id = m.group(1), m.group(2)
+        invalid = {field: f"{field} is not of type string, object." for field in TEXT_FIELDS
+                   if field in body and not _is_text(body[field])}
+        if invalid:
+            return 400, {"code": "rest_invalid_param", "message": f"Invalid parameter(s): {', '.join(invalid)}",
+                         "data": {"status": 400, "params": invalid}}
+        if kind == "media" and filename is not None:
+            self.files[filename] = content
+            body = dict(body, source_url=f"{self.host}/files/{filename}", mime_type="image/png",
+                        media_details={"file": filename, "filesize": len(content)})
+            body.setdefault("slug", filename.rsplit(".", 1)[0])
+        if item_id is not None:
+            if int(item_id) not in self.items[kind]:
+                return 404, {"code": "rest_post_invalid_id", "message": "Invalid post ID."}
+            return 200, self.update(kind, int(item_id), body)
+        if kind in TERM_KINDS:
+            for term in self.items[kind].values():
+                if term["name"].lower() == body.get("name", "").lower():
+                    return 400, {"code": "term_exists", "message": "A term with the name provided already exists.",
+                                 "data": {"status": 400, "term_id": term["id"]}}
+        return 201, self.add(kind, body)
+
+    def start(self):
+        handler = type("Handler", (_Handler,), {"site": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def host(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+def _is_text(value):
+    return isinstance(value, str) or (isinstance(value, dict) and isinstance(value.get("raw"), str))
+
+def _sort_value(value):
+    if isinstance(value, dict):
+        value = value.get("raw", "")
+    return "" if value is None else value
+
+def _project(item, query):
+    if "_fields" not in query:
+        return item
+    fields = query["_fields"][0].split(",")
+    return {field: item[field] for field in fields if field in item}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    site = None
+
+    def log_message(self, *args):
+        pass
+
+    def _begin(self):
+        site = self.site
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        endpoint = re.sub(r"/\d+(?=/|$)", "/<id>", url.path)
+        with site.lock:
+            site.stats["requests"] += 1
+            site.stats["bytes_in"] += length
+            key = f"{self.command} {endpoint}"
+            site.stats["by_endpoint"][key] = site.stats["by_endpoint"].get(key, 0) + 1
+            fail = site.error_rate and site.random.random() < site.error_rate
+            if fail:
+                site.stats["errors"] += 1
+        if site.latency:
+            time.sleep(site.latency)
+        if fail:
+            self._send_json({"code": "unavailable", "message": "Injected error"}, status=503,
+                            headers={"Retry-After": "0"})
+            return None
+        return url.path, parse_qs(url.query), body
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, str(value))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+            with self.site.lock:
+                self.site.stats["bytes_out"] += len(body)
+
+    def _send_json(self, obj, status=200, headers=None):
+        body = json.dumps(obj).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            return self._send(304, b"", {"ETag": etag})
+        self._send(status, body, dict(headers or {}, **{"Content-Type": "application/json", "ETag": etag}))
+
+    def do_GET(self):
+        request = self._begin()
+        if request is None:
+            return
+        path, query, _ = request
+        if path.startswith("/files/"):
+            return self._send_file(path[len("/files/"):])
+        path = path[len("/wp-json/"):].strip("/")
+        if path == "":
+            return self._send_json({"name": "Fake WordPress", "authentication": {}, "routes": {
+                "/batch/v1": {"endpoints": [{"methods": ["POST"], "args": {"requests": {"maxItems": BATCH_MAX_ITEMS}}}]}}})
+        m = re.match(r"wp/v2/(\w+)(?:/(\d+))?$", path)
+        if m is None or m.group(1) not in self.site.items:
+            return self._send_json({"code": "rest_no_route", "message": "No route was found"}, status=404)
+        kind, item_id = m.group(1), m.group(2)
+        if item_id is not None:
+            item = self.site.items[kind].get(int(item_id))
+            if item is None:
+                return self._send_json({"code": "rest_post_invalid_id", "message": "Invalid post ID."}, status=404)
+            return self._send_json(_project(item, query))
+        per_page = int(query.get("per_page", ["10"])[0])
+        page = int(query.get("page", ["1"])[0])
+        if not 1 <= per_page <= 100:
+            return self._send_json({"code": "rest_invalid_param", "message": "Invalid parameter(s): per_page"},
+                                   status=400)
+        items = self.site.list(kind, query)
+        total_pages = max(1, -(-len(items) // per_page))
+        if page > total_pages:
+            return self._send_json({"code": "rest_post_invalid_page_number",
+                                    "message": "The page number requested is larger than the number of pages available."},
+                                   status=400)
+        page_items = [_project(item, query) for item in items[(page - 1) * per_page:page * per_page]]
+        self._send_json(page_items, headers={"X-WP-Total": len(items), "X-WP-TotalPages": total_pages})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def _send_file(self, name):
+        content = self.site.files.get(name)
+        if content is None:
+            return self._send(404, b"", {})
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        headers = {"Accept-Ranges": "bytes", "Content-Type": "application/octet-stream", "ETag": etag}
+        m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if m is None or self.headers.get("If-Range") not in (None, etag):
+            return self._send(200, content, headers)
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else len(content) - 1
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+        self._send(206, content[start:end + 1], headers)
+
+    def do_POST(self):
+        request = self._begin()
+        if request is None:
+            return
+        path, query, body = request
+        path = path[len("/wp-json/"):].strip("/")
+        if path == "batch/v1":
+            requests = json.loads(body)["requests"]
+            if len(requests) > BATCH_MAX_ITEMS:
+                return self._send_json({"code": "rest_invalid_param", "message": "Too many requests"}, status=400)
+            responses = []
+            for sub_request in requests:
+                sub_path = sub_request["path"].strip("/")
+                if re.match(rf"wp/v2/({'|'.join(UNBATCHABLE_KINDS)})(/|$)", sub_path):
+                    status, result = 400, {"code": "rest_batch_not_allowed",
+                                           "message": "The requested route does not support batch requests.",
+                                           "data": {"status": 400}}
+                else:
+                    status, result = self.site.write(sub_path, sub_request.get("body") or {})
+                responses.append({"status": status, "body": result, "headers": {}})
+            return self._send_json({"responses": responses}, status=207)
+        disposition = self.headers.get("Content-Disposition", "")
+        if "filename=" in disposition:
+            status, result = self.site.write(path, {}, disposition.split("filename=")[1].strip('"'), body)
+        else:
+            status, result = self.site.write(path, json.loads(body) if body else {})
+        self._send_json(result, status=status)
@@ -0,0 +1,197 @@
+import argparse
+import gc
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from wpapi import WordPressAPI, WordPressMedia, sync_markdown_directory
+
+from .fake_server import FakeWordPress
+
+# Offline benchmarks against an in-process FakeWordPress. Each scenario gets a fresh site and API,
+# seeds the site outside the measurement, then reports requests seen by the server, injected errors,
+# wall time and peak traced memory (which includes the fake server's threads, so read it as an
+# upper bound). Run from the repository root:
+#
+#     python -m benchmarks.run [scenario ...] [--scale 0.1] [--latency 0.005] [--error-rate 0.01] [--json]
+
+SCENARIOS = {}
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+def _api(site, tmp_dir, **kwargs):
+    return WordPressAPI(site.host, "bench", "bench", media_dir=str(tmp_dir), media_cache_dir=str(tmp_dir), **kwargs)
+
+def _markdown(i, categories, tags):
+    return (f"---\ntitle: Post {i}\ndate: 2024-01-01 10:00:00\ncategories: {categories}\ntags: {tags}\n---\n"
+            f"# Post {i}\n\nSome *markdown* for post {i}, with a [link](https://example.com/{i}).\n\n"
+            + "- an item\n" * 10)
+
+@scenario("paged")
+def paged(site, tmp_dir, scale):
+    # paged() over the whole posts collection
+    n = int(10000 * scale)
+    for i in range(n):
+        site.add("posts", {"slug": f"post-{i}", "title": f"Post {i}", "content": "x" * 200})
+    def run():
+        items = sum(1 for _ in _api(site, tmp_dir).paged("wp/v2/posts"))
+        assert items == n, (items, n)
+        return {"items": items}
+    return run
+
+@scenario("paged_fields")
+def paged_fields(site, tmp_dir, scale):
+    # the same walk with a _fields projection, as the proxies' only() does
+    paged(site, tmp_dir, scale)
+    def run():
+        api = _api(site, tmp_dir)
+        items = sum(1 for _ in api.paged("wp/v2/posts", fields=["id", "slug", "modified_gmt"]))
+        return {"items": items}
+    return run
+
+def _write_sources(src_dir, n):
+    src_dir.mkdir()
+    for i in range(n):
+        categories = ", ".join(f"Category {j}" for j in range(i % 3 + 1))
+        tags = ", ".join(f"tag{(i + j) % 40}" for j in range(3))
+        (src_dir / f"post-{i:05d}.md").write_text(_markdown(i, categories, tags))
+
+@scenario("sync")
+def sync(site, tmp_dir, scale):
+    # sync_markdown_directory over a fresh directory: every file is new
+    src_dir = tmp_dir / "posts"
+    _write_sources(src_dir, int(1000 * scale))
+    def run():
+        sync_markdown_directory(src_dir, _api(site, tmp_dir))
+        posts = list(site.items["posts"].values())
+        not_html = [post["slug"] for post in posts if not post["content"]["raw"].startswith("<h1>")]
+        assert not not_html, f"content not rendered to HTML: {not_html[:5]}"
+        return {"posts": len(posts)}
+    return run
+
+@scenario("sync_unchanged")
+def sync_unchanged(site, tmp_dir, scale):
+    # a re-run where nothing changed, which the manifest should make (almost) free
+    src_dir = tmp_dir / "posts"
+    _write_sources(src_dir, int(1000 * scale))
+    sync_markdown_directory(src_dir, _api(site, tmp_dir))
+    def run():
+        sync_markdown_directory(src_dir, _api(site, tmp_dir))
+        return {"posts": len(site.items["posts"])}
+    return run
+
+@scenario("taxonomy")
+def taxonomy(site, tmp_dir, scale):
+    # resolving category / tag names to ids, a quarter of them new, as from_markdown does per post
+    n = max(4, int(500 * scale))
+    for i in range(n):
+        site.add("categories", {"name": f"Category {i}"})
+        site.add("tags", {"name": f"tag{i}"})
+    def run():
+        api = _api(site, tmp_dir)
+        resolved = 0
+        for i in range(int(2000 * scale)):
+            names = [f"Category {(i * 7 + j) % (n + n // 4)}" for j in range(3)]
+            resolved += len(api.category_ids(names, create_if_missing=True))
+            names = [f"tag{(i * 11 + j) % (n + n // 4)}" for j in range(5)]
+            resolved += len(api.tag_ids(names, create_if_missing=True))
+        return {"resolved": resolved, "categories": len(site.items["categories"]), "tags": len(site.items["tags"])}
+    return run
+
+def _write_files(media_dir, n, size):
+    media_dir.mkdir()
+    for i in range(n):
+        (media_dir / f"image-{i:04d}.png").write_bytes(i.to_bytes(4, "big") * (size // 4))
+
+@scenario("media_upload")
+def media_upload(site, tmp_dir, scale):
+    media_dir = tmp_dir / "media"
+    _write_files(media_dir, max(1, int(100 * scale)), 256 * 1024)
+    def run():
+        api = _api(site, media_dir)
+        for p in sorted(media_dir.glob("*.png")):
+            WordPressMedia(p, {"slug": p.stem, "title": p.stem}, wp_api=api).upload()
+        # as at the end of a publishing job, so the next one (media_reupload) sees the index
+        api.media_index.flush()
+        return {"media": len(site.items["media"]), "bytes_uploaded": sum(len(f) for f in site.files.values())}
+    return run
+
+@scenario("media_reupload")
+def media_reupload(site, tmp_dir, scale):
+    # the same uploads again under new slugs; the dedup index should keep the bytes at home
+    run_upload = media_upload(site, tmp_dir, scale)
+    run_upload()
+    media_dir = tmp_dir / "media"
+    def run():
+        api = _api(site, media_dir)
+        for p in sorted(media_dir.glob("*.png")):
+            WordPressMedia(p, {"slug": f"{p.stem}-copy", "title": p.stem}, wp_api=api).upload()
+        return {"media": len(site.items["media"]), "index": api.media_index.stats}
+    return run
+
+@scenario("media_download")
+def media_download(site, tmp_dir, scale):
+    # mirroring the library into an empty directory with sync_directory
+    for i in range(max(1, int(100 * scale))):
+        site.add_file(f"image-{i:04d}.png", i.to_bytes(4, "big") * (64 * 1024))
+    media_dir = tmp_dir / "media"
+    media_dir.mkdir()
+    def run():
+        stats = _api(site, media_dir).media.sync_directory(media_dir, upload=False)
+        assert not stats["failed"], stats["failed"]
+        return {"downloaded": stats["downloaded"], "bytes": stats["bytes"]}
+    return run
+
+def run_scenario(name, scale=1.0, latency=0.0, error_rate=0.0):
+    with FakeWordPress(latency=0.0) as site, tempfile.TemporaryDirectory() as tmp_dir:
+        run = SCENARIOS[name](site, Path(tmp_dir), scale)
+        # latency and errors apply to the measured part only, not the seeding
+        site.latency = latency
+        site.error_rate = error_rate
+        site.reset_stats()
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            details = run()
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        stats = site.stats
+    return {"scenario": name, "seconds": round(seconds, 3), "requests": stats["requests"],
+            "injected_errors": stats["errors"], "bytes_in": stats["bytes_in"], "bytes_out": stats["bytes_out"],
+            "peak_mb": round(peak / (1 << 20), 2), "details": details, "by_endpoint": stats["by_endpoint"]}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline wpapi benchmarks against a fake WordPress.")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier on each scenario's item count")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    if not args.json:
+        print(f"{'scenario':<16} {'seconds':>9} {'requests':>9} {'errors':>7} {'peak MB':>8}  details")
+    results = []
+    for name in args.scenarios or list(SCENARIOS):
+        result = run_scenario(name, scale=args.scale, latency=args.latency, error_rate=args.error_rate)
+        results.append(result)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{name:<16} {result['seconds']:>9.3f} {result['requests']:>9} {result['injected_errors']:>7} "
+                  f"{result['peak_mb']:>8.2f}  {json.dumps(result['details'])}")
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,7 @@ setup(name="wpapi",
       url="https://github.com/quantology/wpapi",
       packages=packages,
       install_requires=["mistune", "frontmatter", "requests"],
+      extras_require={"async": ["aiohttp"], "watch": ["inotify_simple"]},
       description="Python WordPress API",
       long_description=long_description,
       long_description_content_type='text/markdown',
@@ -1,4 +1,5 @@
 from .core import WordPressAPI
 from .posts import WordPressPost
 from .media import WordPressMedia
-from .sync import sync_markdown_directory
+from .sync import sync_markdown_directory, watch_markdown_directory, pull_directory
+from .aio import AsyncWordPressAPI
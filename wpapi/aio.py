@@ -0,0 +1,226 @@
+import asyncio
+import json
+from pathlib import Path
+from typing import Optional, AsyncIterator
+
+from .utils import UNDEFINED, guess_mime_type
+from .posts import WordPressPost
+from .media import WordPressMedia
+from .slugs import POST_STATUSES
+
+class AsyncWordPressAPI:
+    # asyncio counterpart of WordPressAPI; needs aiohttp (pip install wpapi[async])
+    # all requests share one ClientSession and are bounded by max_concurrency
+    def __init__(self, host, username=None, app_password=UNDEFINED, *, max_concurrency=16, debug=False, media_dir="./"):
+        self.host = host
+        self.username = username
+        self.app_password = app_password
+        self.max_concurrency = max_concurrency
+        self.debug = debug
+        self.media_dir = media_dir
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import aiohttp
+            auth = None
+            if self.app_password is not UNDEFINED:
+                auth = aiohttp.BasicAuth(self.username, self.app_password)
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self._session = aiohttp.ClientSession(auth=auth, connector=connector,
+                                                  headers={"Cache-Control": "no-cache"})
+        return self._session
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def request(self, method, endpoint, **kwargs):
+        # returns (headers, decoded json)
+        async with self.semaphore:
+            async with self.session.request(method, f"{self.host}/wp-json/{endpoint}", **kwargs) as r:
+                body = await r.read()
+                if not (200 <= r.status < 300) and self.debug:
+                    print(body.decode(errors="replace"))
+                r.raise_for_status()
+                return r.headers, json.loads(body)
+
+    async def get(self, endpoint, **params):
+        _, data = await self.request("GET", endpoint, params=params)
+        return data
+
+    async def post(self, endpoint, **kwargs):
+        _, data = await self.request("POST", endpoint, **kwargs)
+        return data
+
+    async def paged(self, endpoint, per_page=100, **params) -> AsyncIterator[dict]:
+        # the first page tells us how many there are; the rest are fetched concurrently
+        headers, first_page = await self.request("GET", endpoint, params=dict(params, page=1, per_page=per_page))
+        if "X-WP-TotalPages" not in headers:
+            # no pagination headers (e.g. behind a stripping proxy): walk until a short page
+            page, page_data = 1, first_page
+            for item in page_data:
+                yield item
+            while len(page_data) == per_page:
+                page += 1
+                page_data = await self.get(endpoint, page=page, per_page=per_page, **params)
+                for item in page_data:
+                    yield item
+            return
+        total_pages = int(headers["X-WP-TotalPages"])
+        tasks = [asyncio.ensure_future(self.get(endpoint, page=page, per_page=per_page, **params))
+                 for page in range(2, total_pages + 1)]
+        try:
+            for item in first_page:
+                yield item
+            for task in tasks:
+                for item in await task:
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def info(self):
+        return await self.get("")
+
+    @property
+    def posts(self):
+        return AsyncWordPressPostsProxy(self)
+
+    @property
+    def media(self):
+        return AsyncWordPressMediaProxy(self, self.media_dir)
+
+    async def save_all(self, objs):
+        # saves posts / uploads media concurrently, up to max_concurrency in flight
+        async def save(obj):
+            if isinstance(obj, AsyncWordPressMedia):
+                return await obj.upload()
+            return await obj.save()
+        return await asyncio.gather(*[save(obj) for obj in objs])
+
+class AsyncWordPressPost(WordPressPost):
+    async def save(self):
+        assert self.wp_api is not None
+        existing_id = self.data.get("id")
+        if existing_id is None:
+            existing_post = await self.wp_api.posts.get(self.data["slug"])
+            if existing_post is not None:
+                existing_id = existing_post.data["id"]
+            elif self.wp_api.debug:
+                print("none existing:", self.data["slug"])
+        post_to_url = "wp/v2/posts/"
+        if existing_id is not None:
+            if self.wp_api.debug:
+                print("updating existing:", existing_id)
+            post_to_url += str(existing_id)
+        result = await self.wp_api.post(post_to_url, json=self.data)
+        assert result["slug"] == self.data["slug"]
+        return result
+
+class AsyncWordPressPostsProxy:
+    def __init__(self, wp_api):
+        self.wp_api = wp_api
+
+    async def __aiter__(self) -> AsyncIterator[AsyncWordPressPost]:
+        async for post_data in self.wp_api.paged("wp/v2/posts"):
+            yield AsyncWordPressPost(post_data, wp_api=self.wp_api)
+
+    async def get(self, slug) -> Optional[AsyncWordPressPost]:
+        posts = await self.wp_api.get("wp/v2/posts", slug=slug, status=",".join(POST_STATUSES))
+        if not posts:
+            return None
+        if self.wp_api.debug and len(posts) > 1:
+            print(posts)
+        assert len(posts) == 1
+        return AsyncWordPressPost(posts[0], wp_api=self.wp_api)
+
+    async def set(self, slug, post: WordPressPost):
+        slugged_post = AsyncWordPressPost(dict(post.data, slug=slug), wp_api=self.wp_api)
+        return await slugged_post.save()
+
+class AsyncWordPressMedia(WordPressMedia):
+    async def download(self, to_path=None, replace_existing=False, chunk_size=65536):
+        path = self.path if to_path is None else Path(to_path)
+        if path.is_dir():
+            path = path / self.url.split("/")[-1]
+        if path.exists() and not replace_existing:
+            raise RuntimeError(f"File already exists at {path!r}: use replace_existing=True to overwrite.")
+        async with self.wp_api.semaphore:
+            async with self.wp_api.session.get(self.url) as r:
+                r.raise_for_status()
+                try:
+                    with path.open(mode="wb") as f:
+                        async for chunk in r.content.iter_chunked(chunk_size):
+                            f.write(chunk)
+                except:
+                    path.unlink()
+                    raise
+        return path
+
+    async def upload(self):
+        assert self.wp_api is not None
+        assert self.path.exists()
+        existing_id = self.metadata.get("id")
+        if existing_id is None:
+            existing_media = await self.wp_api.media.get(self.metadata["slug"])
+            if existing_media is not None:
+                existing_id = existing_media.metadata["id"]
+            elif self.wp_api.debug:
+                print("none existing:", self.metadata["slug"])
+        post_to_url = "wp/v2/media/"
+        if existing_id is not None:
+            if self.wp_api.debug:
+                print("updating existing:", existing_id)
+            post_to_url += str(existing_id)
+        if "slug" in self.metadata:
+            fname = f"{self.metadata['slug']}{self.path.suffix}"
+        else:
+            fname = self.path.name
+        with self.path.open(mode="rb") as fp:
+            return await self.wp_api.post(post_to_url, data=fp,
+                                          headers={"Content-Type": guess_mime_type(self.path),
+                                                   "Content-Disposition": f"attachment; filename={fname}"})
+
+class AsyncWordPressMediaProxy:
+    def __init__(self, wp_api, local_dir=None):
+        self.wp_api = wp_api
+        self.local_dir = local_dir
+
+    async def __aiter__(self) -> AsyncIterator[AsyncWordPressMedia]:
+        async for media_data in self.wp_api.paged("wp/v2/media/"):
+            yield AsyncWordPressMedia(self.local_dir, media_data, wp_api=self.wp_api)
+
+    async def get(self, key, local_dir=None) -> Optional[AsyncWordPressMedia]:
+        if local_dir is None:
+            local_dir = self.local_dir
+        if isinstance(key, str):
+            media = await self.wp_api.get("wp/v2/media", slug=key)
+            if not media:
+                return None
+            if self.wp_api.debug and len(media) > 1:
+                print(media)
+            assert len(media) == 1
+            media_data = media[0]
+        elif isinstance(key, int):
+            media_data = await self.wp_api.get(f"wp/v2/media/{key}")
+        return AsyncWordPressMedia(local_dir, media_data, wp_api=self.wp_api)
+
+    async def set(self, slug, media: WordPressMedia):
+        slugged_media = AsyncWordPressMedia(media.path, dict(media.metadata, slug=slug), wp_api=self.wp_api)
+        return await slugged_media.upload()
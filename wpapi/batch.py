@@ -0,0 +1,116 @@
+import re
+
+import requests
+
+# routes whose controllers set allow_batch = false; writes to them are sent one request each
+UNBATCHABLE = re.compile(r"^/?wp/v2/media(/|$)")
+
+class BatchItem:
+    # one queued write; status / result / error are filled in when its batch is flushed
+    def __init__(self, method, endpoint, body=None, callback=None, obj=None):
+        self.method = method
+        self.endpoint = endpoint
+        self.body = body
+        self.callback = callback
+        self.obj = obj
+        self.status = None
+        self.result = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.status is not None
+
+    @property
+    def ok(self):
+        return self.status is not None and 200 <= self.status < 300 and self.error is None
+
+    def resolve(self, status, body):
+        self.status = status
+        if 200 <= status < 300:
+            self.result = body
+            if self.callback is not None:
+                try:
+                    self.callback(body)
+                except Exception as e:
+                    # the write went through, but this item's follow-up failed; the rest of the batch still resolves
+                    self.error = {"code": "callback_error", "message": repr(e)}
+        else:
+            self.error = body
+
+    def __repr__(self):
+        return f"<BatchItem {self.method} {self.endpoint} status={self.status}>"
+
+class WordPressBatch:
+    # queues JSON writes and sends them through batch/v1 in chunks of the server's maximum size
+    # (falling back to one request each on servers without the batch endpoint, and for routes that
+    # don't allow batching); errors are per item
+    def __init__(self, wp_api, max_size=None):
+        self.wp_api = wp_api
+        self._max_size = max_size
+        self.queue = []
+        self.items = []
+
+    @property
+    def max_size(self):
+        # looked up on first use, so a batch that never queues anything costs no request
+        if self._max_size is None:
+            self._max_size = self.wp_api.batch_max_size or 0
+        return self._max_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, method, endpoint, body=None, callback=None, obj=None):
+        item = BatchItem(method, endpoint, body, callback=callback, obj=obj)
+        self.queue.append(item)
+        self.items.append(item)
+        if self.max_size and len(self.queue) >= self.max_size:
+            self.flush()
+        return item
+
+    def post(self, endpoint, json=None, callback=None, obj=None):
+        return self.add("POST", endpoint, json, callback=callback, obj=obj)
+
+    def flush(self):
+        queue, self.queue = self.queue, []
+        if not queue:
+            return queue
+        max_size = self.max_size
+        batchable = []
+        for item in queue:
+            if max_size and not UNBATCHABLE.match(item.endpoint):
+                batchable.append(item)
+            else:
+                self._send_one(item)
+        for i in range(0, len(batchable), max_size or 1):
+            chunk = batchable[i:i + max_size]
+            result = self.wp_api.post("batch/v1", json={
+                "validation": "normal",
+                "requests": [{"method": item.method, "path": "/" + item.endpoint.strip("/"), "body": item.body or {}}
+                             for item in chunk]})
+            for item, response in zip(chunk, result["responses"]):
+                item.resolve(response["status"], response["body"])
+        return queue
+
+    def _send_one(self, item):
+        try:
+            r = self.wp_api.request(item.method, item.endpoint, json=item.body)
+        except requests.HTTPError as e:
+            if e.response is None:
+                raise
+            try:
+                body = e.response.json()
+            except ValueError:
+                body = {"message": e.response.text}
+            item.resolve(e.response.status_code, body)
+        else:
+            item.resolve(r.status_code, r.json())
+
+    @property
+    def errors(self):
+        return [item for item in self.items if item.done and not item.ok]
@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from .utils import load_json, dump_json
+
+# headers worth keeping with a cached body (pagination is read back by WordPressAPI.paged)
+KEPT_HEADERS = ["Content-Type", "ETag", "Last-Modified", "X-WP-Total", "X-WP-TotalPages"]
+
+class CachedResponse:
+    # the parts of requests.Response that WordPressAPI's readers use
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    @property
+    def text(self):
+        return self.content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+class ResponseCache:
+    # LRU cache of GET responses keyed by endpoint + params, bounded by total body size.
+    # Entries younger than max_age seconds are served without a request; older ones are
+    # revalidated with If-None-Match / If-Modified-Since, so an unchanged resource costs a 304.
+    # Any write through the API marks every entry stale (but still revalidatable).
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_age=0, path=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.path = path
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = 0
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        if path is not None:
+            for key, entry in load_json(path, default={}).items():
+                entry["generation"] = self.generation
+                self._add(key, entry)
+
+    @staticmethod
+    def key(endpoint, params=None):
+        params = sorted((params or {}).items())
+        return f"{endpoint}?{urlencode(params, doseq=True)}"
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def is_fresh(self, entry):
+        fresh = (entry["generation"] == self.generation
+                 and time.time() - entry["stored_at"] < self.max_age)
+        if fresh:
+            self.stats["hits"] += 1
+        return fresh
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry["headers"].get("ETag"):
+                headers["If-None-Match"] = entry["headers"]["ETag"]
+            if entry["headers"].get("Last-Modified"):
+                headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+        return headers
+
+    def revalidated(self, entry):
+        with self._lock:
+            self.stats["revalidated"] += 1
+            entry["stored_at"] = time.time()
+            entry["generation"] = self.generation
+        return self.response(entry)
+
+    def store(self, key, r):
+        self.stats["misses"] += 1
+        headers = {name: r.headers[name] for name in KEPT_HEADERS if name in r.headers}
+        if self.max_age <= 0 and "ETag" not in headers and "Last-Modified" not in headers:
+            # nothing to revalidate against and never fresh: not worth keeping
+            return
+        entry = {"status": r.status_code, "headers": headers, "content": r.text,
+                 "stored_at": time.time(), "generation": self.generation}
+        with self._lock:
+            self._add(key, entry)
+
+    def _add(self, key, entry):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)["content"])
+        self.entries[key] = entry
+        self.size += len(entry["content"])
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted["content"])
+            self.stats["evictions"] += 1
+
+    @staticmethod
+    def response(entry):
+        return CachedResponse(entry["status"], entry["headers"], entry["content"])
+
+    def expire(self):
+        self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+    def save(self):
+        assert self.path is not None
+        with self._lock:
+            dump_json(self.path, dict(self.entries))
@@ -1,10 +1,24 @@
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
+from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from .utils import UNDEFINED, to_datetime, from_datetime, url
+from .utils import UNDEFINED, to_datetime, from_datetime, url, retry_after, TokenBucket
 from .posts import WordPressPostsProxy
-from .media import WordPressMediaProxy
+from .media import WordPressMediaProxy, MediaHashCache, MediaDedupIndex, HASH_CACHE_NAME, DEDUP_INDEX_NAME, site_key
+from .terms import TermIndex
+from .slugs import SlugIndex, POST_STATUSES, MEDIA_STATUSES
+from .batch import WordPressBatch
+from .cache import ResponseCache
+from .metrics import RequestMetrics
+from .export import export_site, import_site
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
 
 class WordPressAPI:
     # cf https://make.wordpress.org/core/2020/11/05/application-passwords-integration-guide/
@@ -13,10 +27,25 @@ class WordPressAPI:
     # todo -- make this somehow a salt of the install environment?
     default_uuid = "80adaaed-dce3-48bc-aa36-a502483beac9"
 
-    def __init__(self, host, username=None, app_password=UNDEFINED, *, app_name="WordPress Python API", app_uuid=None, debug=False, media_dir="./"):
+    def __init__(self, host, username=None, app_password=UNDEFINED, *, app_name="WordPress Python API", app_uuid=None, debug=False, media_dir="./", media_cache_dir=None, max_workers=8, term_ttl=None, cache=None,
+                 retries=3, backoff=0.5, max_backoff=30, rate_limit=None, burst=None, pool_size=None):
         self.host = host
         self.session = requests.Session()
-        self.session.headers.update({"Cache-Control": "no-cache"})
+        # size the pool for the concurrent paths (paged, media sync), or they queue for connections
+        pool_size = max(10, 2 * max_workers) if pool_size is None else pool_size
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # rate_limit is requests per second across all threads, with bursts of up to burst requests
+        self.rate_limiter = None if rate_limit is None else TokenBucket(rate_limit, burst)
+        self.metrics = RequestMetrics()
+        # cache=True for an in-memory ResponseCache, or pass one (e.g. persisted to disk)
+        self.cache = ResponseCache() if cache is True else (cache or None)
+        if self.cache is None:
+            self.session.headers.update({"Cache-Control": "no-cache"})
         self.app_name = app_name
         self.app_uuid = WordPressAPI.default_uuid if app_uuid is None else app_uuid
         self.username = username
@@ -27,6 +56,14 @@ class WordPressAPI:
             self.session.auth = (username, app_password)
         self.debug = debug
         self.media_dir = media_dir
+        # media_cache_dir persists media hashes and the upload dedup index (one file per site) across runs;
+        # without it they only live as long as this object, and nothing is written to media_dir
+        self.media_cache_dir = media_cache_dir
+        self.max_workers = max_workers
+        self.category_index = TermIndex(self, "wp/v2/categories", label="Categories", ttl=term_ttl)
+        self.tag_index = TermIndex(self, "wp/v2/tags", label="Tags", ttl=term_ttl)
+        self.post_slugs = SlugIndex(self, "wp/v2/posts", POST_STATUSES)
+        self.media_slugs = SlugIndex(self, "wp/v2/media", MEDIA_STATUSES)
 
     def authorization_url(self):
         info = self.info
@@ -40,86 +77,178 @@ class WordPressAPI:
         self.app_password = app_password
         self.session.auth = (username, app_password)
 
-    def get(self, endpoint, **params):
-        r = self.session.get(f"{self.host}/wp-json/{endpoint}", params=params)
+    def request(self, method, endpoint, **kwargs):
+        cache_key = entry = None
+        if self.cache is not None:
+            if method == "GET":
+                cache_key = self.cache.key(endpoint, kwargs.get("params"))
+                entry = self.cache.lookup(cache_key)
+                if entry is not None and self.cache.is_fresh(entry):
+                    return self.cache.response(entry)
+                kwargs["headers"] = dict(kwargs.get("headers") or {}, **self.cache.conditional_headers(entry))
+            else:
+                self.cache.expire()
+        r = self._send(method, endpoint, **kwargs)
+        if cache_key is not None:
+            if r.status_code == 304 and entry is not None:
+                return self.cache.revalidated(entry)
+            if r.ok:
+                self.cache.store(cache_key, r)
         if not (200 <= r.status_code < 300) and self.debug:
             print(r.text)
         r.raise_for_status()
-        return r.json()
+        return r
+
+    def _send(self, method, endpoint, **kwargs):
+        # one logical request: rate limited, and retried with jittered exponential backoff (honouring
+        # Retry-After) on connection errors and retryable statuses; non-idempotent methods are only
+        # retried when the server refused the request outright (429 / 503)
+        idempotent = method in IDEMPOTENT_METHODS
+        # streamed bodies have to be rewound before a retry; ones that can't be are sent once
+        body = kwargs.get("data")
+        body_start = body.tell() if hasattr(body, "seek") else None
+        rewindable = not hasattr(body, "read") or body_start is not None
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            if attempt and body_start is not None:
+                body.seek(body_start)
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, f"{self.host}/wp-json/{endpoint}", **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.metrics.record(method, endpoint, time.perf_counter() - start, "error")
+                if attempt == self.retries or not idempotent:
+                    raise
+                reason, delay = type(e).__name__, None
+            else:
+                self.metrics.record(method, endpoint, time.perf_counter() - start, r.status_code,
+                                    bytes_in=len(r.content), bytes_out=int(r.request.headers.get("Content-Length", 0)))
+                retryable = r.status_code in (429, 503) or (idempotent and r.status_code in (500, 502, 504))
+                if not retryable or attempt == self.retries or not rewindable:
+                    return r
+                reason, delay = r.status_code, retry_after(r.headers.get("Retry-After"))
+            if delay is None:
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            self.metrics.record_retry(method, endpoint, reason)
+            if self.debug:
+                print(f"retrying {method} {endpoint} in {delay:.2f}s ({reason})")
+            time.sleep(min(delay, self.max_backoff))
+
+    def get(self, endpoint, **params):
+        return self.request("GET", endpoint, params=params).json()
 
-    def paged(self, endpoint, per_page=10, **params):
-        page = 1
-        page_data = None
-        while page_data is None or len(page_data) == per_page:
-            page_data = self.get(endpoint, page=page, per_page=per_page, **params)
+    def paged(self, endpoint, per_page=100, max_workers=None, fields=None, **params):
+        # fields projects each item down to those keys (the _fields parameter)
+        for _, page_data in self.pages(endpoint, per_page=per_page, max_workers=max_workers, fields=fields, **params):
             yield from page_data
-            page += 1
+
+    def pages(self, endpoint, per_page=100, max_workers=None, fields=None, start_page=1, **params):
+        # yields (page number, items). The first page's X-WP-TotalPages header tells us how many
+        # pages to fetch; the rest are fetched concurrently (at most max_workers in flight) and
+        # yielded in order. start_page lets a checkpointed walk pick up where it stopped
+        if fields is not None:
+            params["_fields"] = ",".join(fields)
+        try:
+            r = self.request("GET", endpoint, params=dict(params, page=start_page, per_page=per_page))
+        except requests.HTTPError as e:
+            # resuming past the last page (items were deleted since) is just the end
+            if start_page > 1 and e.response is not None and e.response.status_code == 400:
+                return
+            raise
+        page_data = r.json()
+        if "X-WP-TotalPages" not in r.headers:
+            # no pagination headers (e.g. behind a stripping proxy): walk until a short page
+            page = start_page
+            yield page, page_data
+            while len(page_data) == per_page:
+                page += 1
+                page_data = self.get(endpoint, page=page, per_page=per_page, **params)
+                yield page, page_data
+            return
+        total_pages = int(r.headers["X-WP-TotalPages"])
+        if total_pages <= start_page:
+            yield start_page, page_data
+            return
+        max_workers = self.max_workers if max_workers is None else max_workers
+        pages = iter(range(start_page + 1, total_pages + 1))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            # keep a bounded window of pages in flight so a slow consumer doesn't buffer the site
+            pending = deque((page, executor.submit(self.get, endpoint, page=page, per_page=per_page, **params))
+                            for _, page in zip(range(2 * max_workers), pages))
+            yield start_page, page_data
+            while pending:
+                page, future = pending.popleft()
+                page_data = future.result()
+                for next_page in pages:
+                    pending.append((next_page, executor.submit(self.get, endpoint, page=next_page,
+                                                               per_page=per_page, **params)))
+                    break
+                yield page, page_data
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
     def post(self, endpoint, **kwargs):
-        r = self.session.post(f"{self.host}/wp-json/{endpoint}", **kwargs)
-        if not (200 <= r.status_code < 300) and self.debug:
-            print(r.text)
-        r.raise_for_status()
-        return r.json()
+        return self.request("POST", endpoint, **kwargs).json()
     
     @cached_property
     def info(self):
         return self.get("")
 
+    @cached_property
+    def batch_max_size(self):
+        # None if the server has no batch endpoint (WordPress < 5.6)
+        route = self.info.get("routes", {}).get("/batch/v1")
+        if route is None:
+            return None
+        try:
+            return route["endpoints"][0]["args"]["requests"]["maxItems"]
+        except (KeyError, IndexError):
+            return 25
+
+    def batch(self, max_size=None):
+        return WordPressBatch(self, max_size=max_size)
+
+    def export(self, out_dir, **kwargs):
+        # see export.export_site
+        return export_site(self, out_dir, **kwargs)
+
+    def import_dump(self, dump_dir, **kwargs):
+        # see export.import_site
+        return import_site(self, dump_dir, **kwargs)
+
     @property
     def posts(self):
         return WordPressPostsProxy(self)
     
+    @cached_property
+    def media_hashes(self):
+        if self.media_cache_dir is None:
+            return MediaHashCache()
+        return MediaHashCache(Path(self.media_cache_dir) / HASH_CACHE_NAME)
+
+    @cached_property
+    def media_index(self):
+        # content hash -> remote media item, so uploads of known bytes are skipped
+        if self.media_cache_dir is None:
+            return MediaDedupIndex()
+        return MediaDedupIndex(Path(self.media_cache_dir) / DEDUP_INDEX_NAME.format(site=site_key(self.host)))
+
     @property
     def media(self):
         return WordPressMediaProxy(self, self.media_dir)
 
     @property
     def categories(self):
-        result = {}
-        for cat in self.paged("wp/v2/categories"):
-            result[cat["id"]] = (cat["name"], cat["slug"], cat["description"])
-        return result
+        return self.category_index.terms
 
     def category_ids(self, category_names, create_if_missing=False):
-        required_categories = set(category_names)
-        cat_ids = set()
-        for (cat_id, (name, slug, desc)) in self.categories.items():
-            name_lower = name.lower()
-            matches = [cat_name for cat_name in required_categories if cat_name.lower() == name_lower]
-            if matches:
-                cat_ids.add(cat_id)
-                for match in matches:
-                    required_categories.remove(match)
-        if required_categories:
-            if not create_if_missing:
-                raise ValueError(f"Categories not found: {required_categories!r}")
-            for new_category_name in required_categories:
-                new_cat = self.post("wp/v2/categories", json={"name": new_category})
-                cat_ids.add(new_cat["id"])
-        return cat_ids
+        return self.category_index.ids(category_names, create_if_missing=create_if_missing)
 
     @property
     def tags(self):
-        result = {}
-        for tag in self.paged("wp/v2/tags"):
-            result[tag["id"]] = (tag["name"], tag["slug"], tag["description"])
-        return result
+        return self.tag_index.terms
 
     def tag_ids(self, tag_names, create_if_missing=False):
-        required_tags = set(tag_names)
-        tag_ids = set()
-        for (tag_id, (name, slug, desc)) in self.tags.items():
-            name_lower = name.lower()
-            matches = [tag_name for tag_name in required_tags if tag_name.lower() == name_lower]
-            if matches:
-                tag_ids.add(tag_id)
-                for match in matches:
-                    required_tags.remove(match)
-        if required_tags:
-            if not create_if_missing:
-                raise ValueError(f"Tags not found: {required_tags!r}")
-            for new_tag_name in required_tags:
-                new_tag = self.post("wp/v2/tags", json={"name": new_tag_name})
-                tag_ids.add(new_tag["id"])
-        return tag_ids
+        return self.tag_index.ids(tag_names, create_if_missing=create_if_missing)
@@ -0,0 +1,216 @@
+import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .media import WordPressMedia
+from .slugs import SlugIndex, POST_STATUSES, MEDIA_STATUSES
+from .utils import load_json, dump_json, download_file
+
+CHECKPOINT_NAME = "checkpoint.json"
+
+# (kind, endpoint, statuses); terms come first so an import can map their ids before the posts
+EXPORT_KINDS = [
+    ("categories", "wp/v2/categories", None),
+    ("tags", "wp/v2/tags", None),
+    ("media", "wp/v2/media", MEDIA_STATUSES),
+    ("pages", "wp/v2/pages", POST_STATUSES),
+    ("posts", "wp/v2/posts", POST_STATUSES),
+]
+
+# fields sent back on import; everything else in a dump is read-only or site-specific
+WRITABLE_FIELDS = {
+    "posts": ["slug", "status", "date", "title", "content", "excerpt", "comment_status", "ping_status",
+              "format", "sticky", "categories", "tags", "featured_media", "meta"],
+    "pages": ["slug", "status", "date", "title", "content", "excerpt", "comment_status", "ping_status",
+              "parent", "menu_order", "template", "featured_media", "meta"],
+    "media": ["slug", "title", "caption", "alt_text", "description"],
+    "categories": ["name", "description", "parent"],
+    "tags": ["name", "description"],
+}
+
+def _shard_path(out_dir, kind, shard):
+    return out_dir / f"{kind}-{shard:05d}.jsonl.gz"
+
+def _media_path(files_dir, item):
+    # keyed by id: basenames repeat across upload months (2023/05/a.jpg, 2024/01/a.jpg)
+    return files_dir / f"{item['id']}-{item['source_url'].split('/')[-1]}"
+
+def export_site(wp_api, out_dir, kinds=None, pages_per_shard=100, include_files=False, max_workers=None):
+    # Streams the site to gzipped JSONL shards, one page in memory at a time. Each page is appended
+    # as its own gzip member and the checkpoint (next page, shard, shard size, last id) saved after
+    # it, so a failed run resumes from the last finished page, truncating any half-written member.
+    # Items are listed by ascending id, so new items land after the checkpoint; a resume re-reads
+    # the page before it and skips ids already written, in case deletions shifted the pages back.
+    # include_files also downloads media binaries into files/ on a thread pool alongside.
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint_path = out_dir / CHECKPOINT_NAME
+    checkpoint = load_json(checkpoint_path, default={})
+    kinds = [kind for kind in EXPORT_KINDS if kinds is None or kind[0] in kinds]
+    files_dir = out_dir / "files"
+    max_workers = wp_api.max_workers if max_workers is None else max_workers
+    downloads = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for (kind, endpoint, statuses) in kinds:
+            state = checkpoint.setdefault(kind, {"page": 1, "shard": 0, "shard_bytes": 0, "shard_pages": 0,
+                                                 "count": 0, "done": False})
+            if state["done"]:
+                continue
+            shard_path = _shard_path(out_dir, kind, state["shard"])
+            if shard_path.exists():
+                with shard_path.open(mode="r+b") as fp:
+                    fp.truncate(state["shard_bytes"])
+            params = {"context": "edit", "orderby": "id", "order": "asc"}
+            if statuses is not None:
+                params["status"] = ",".join(statuses)
+            last_id = state.get("last_id", 0)
+            with wp_api.metrics.timer(f"export.{kind}"):
+                for page, items in wp_api.pages(endpoint, start_page=max(1, state["page"] - 1), **params):
+                    items = [item for item in items if item["id"] > last_id]
+                    if not items:
+                        continue
+                    last_id = items[-1]["id"]
+                    if state["shard_pages"] >= pages_per_shard:
+                        state["shard"] += 1
+                        state["shard_bytes"] = state["shard_pages"] = 0
+                        shard_path = _shard_path(out_dir, kind, state["shard"])
+                        if shard_path.exists():
+                            # left over from a run that died right after rotating
+                            shard_path.unlink()
+                    with gzip.open(shard_path, mode="at") as fp:
+                        for item in items:
+                            fp.write(json.dumps(item))
+                            fp.write("\n")
+                    if include_files and kind == "media":
+                        files_dir.mkdir(exist_ok=True)
+                        downloads.extend(executor.submit(download_file, item["source_url"],
+                                                         _media_path(files_dir, item), session=wp_api.session)
+                                         for item in items)
+                    state.update(page=page + 1, count=state["count"] + len(items), last_id=last_id,
+                                 shard_bytes=shard_path.stat().st_size, shard_pages=state["shard_pages"] + 1)
+                    dump_json(checkpoint_path, checkpoint)
+            state["done"] = True
+            dump_json(checkpoint_path, checkpoint)
+        for future in downloads:
+            future.result()
+    return {kind: state["count"] for (kind, state) in checkpoint.items()}
+
+def read_dump(dump_dir, kind):
+    for shard_path in sorted(Path(dump_dir).glob(f"{kind}-*.jsonl.gz")):
+        with gzip.open(shard_path, mode="rt") as fp:
+            for line in fp:
+                yield json.loads(line)
+
+def _writable(kind, item, id_maps):
+    body = {}
+    for field in WRITABLE_FIELDS[kind]:
+        if field not in item:
+            continue
+        value = item[field]
+        if isinstance(value, dict) and ("raw" in value or "rendered" in value):
+            value = value.get("raw", value.get("rendered"))
+        body[field] = value
+    for (field, id_kind) in [("categories", "categories"), ("tags", "tags")]:
+        if field in body:
+            body[field] = [id_maps[id_kind][old_id] for old_id in body[field] if old_id in id_maps[id_kind]]
+    if body.get("featured_media"):
+        body["featured_media"] = id_maps["media"].get(body["featured_media"], 0)
+    if body.get("parent"):
+        # a parent not imported (yet) is left at the top level; import_site fills it in later
+        body["parent"] = id_maps[kind].get(body["parent"], 0)
+    return body
+
+def _by_depth(terms):
+    # terms grouped by depth in their hierarchy, so each level's parents are created before it
+    by_id = {term["id"]: term for term in terms}
+    depths = {}
+    def depth(term):
+        if term["id"] not in depths:
+            depths[term["id"]] = 0  # guards against a cycle in a broken dump
+            parent = by_id.get(term.get("parent") or 0)
+            depths[term["id"]] = 0 if parent is None else depth(parent) + 1
+        return depths[term["id"]]
+    levels = {}
+    for term in terms:
+        levels.setdefault(depth(term), []).append(term)
+    return [levels[level] for level in sorted(levels)]
+
+def import_site(wp_api, dump_dir, kinds=None):
+    # Replays an export_site dump into wp_api's site. Terms are matched by name (created with their
+    # description and parent if missing), media are uploaded from files/ when the dump has them,
+    # and posts / pages are written through batch/v1, updating items whose slug already exists.
+    # Ids are remapped (categories, tags, featured_media, parents); authors are not, so imported
+    # items belong to the caller. Dumps list pages by id, so a page whose parent comes later is
+    # written at the top level first and moved under its parent once all pages are in.
+    dump_dir = Path(dump_dir)
+    kinds = [kind for (kind, _, _) in EXPORT_KINDS if kinds is None or kind in kinds]
+    id_maps = {"categories": {}, "tags": {}, "media": {}, "pages": {}, "posts": {}}
+    stats = {"failed": {}}
+    for (kind, index) in [("categories", wp_api.category_index), ("tags", wp_api.tag_index)]:
+        if kind not in kinds:
+            continue
+        for terms in _by_depth(list(read_dump(dump_dir, kind))):
+            missing = {term["name"]: _writable(kind, term, id_maps) for term in terms
+                       if index.get(term["name"]) is None}
+            if missing:
+                index.create_many(list(missing), fields=missing)
+            for term in terms:
+                id_maps[kind][term["id"]] = index.get(term["name"])
+        stats[kind] = len(set(id_maps[kind].values()))
+    if "media" in kinds:
+        stats["media"] = 0
+        files_dir = dump_dir / "files"
+        with wp_api.batch() as batch:
+            for item in read_dump(dump_dir, "media"):
+                path = _media_path(files_dir, item)
+                if not path.exists():
+                    continue
+                try:
+                    result = WordPressMedia(path, {"slug": item["slug"]}, wp_api=wp_api).upload()
+                except Exception as e:
+                    stats["failed"][f"media/{item['slug']}"] = repr(e)
+                    continue
+                id_maps["media"][item["id"]] = result["id"]
+                batch.post(f"wp/v2/media/{result['id']}", json=_writable("media", item, id_maps), obj=item)
+                stats["media"] += 1
+        for batch_item in batch.errors:
+            stats["failed"][f"media/{batch_item.obj['slug']}"] = batch_item.error
+    for kind in ["pages", "posts"]:
+        if kind not in kinds:
+            continue
+        slugs = wp_api.post_slugs if kind == "posts" else SlugIndex(wp_api, "wp/v2/pages", POST_STATUSES)
+        stats[kind] = 0
+        # slugs are resolved and written 500 items at a time, keeping memory bounded
+        chunk = []
+        orphans = {}  # new id -> old parent id, for parents not written yet
+        def flush():
+            slugs.prefetch([item["slug"] for item in chunk])
+            unparented = {item["id"] for item in chunk if item.get("parent") and item["parent"] not in id_maps[kind]}
+            with wp_api.batch() as batch:
+                for item in chunk:
+                    existing_id = slugs.get(item["slug"])
+                    endpoint = f"wp/v2/{kind}" + ("" if existing_id is None else f"/{existing_id}")
+                    batch.post(endpoint, json=_writable(kind, item, id_maps), obj=item)
+            for batch_item in batch.items:
+                if batch_item.ok:
+                    slugs.add(batch_item.result["slug"], batch_item.result["id"])
+                    id_maps[kind][batch_item.obj["id"]] = batch_item.result["id"]
+                    if batch_item.obj["id"] in unparented:
+                        orphans[batch_item.result["id"]] = batch_item.obj["parent"]
+                    stats[kind] += 1
+                else:
+                    stats["failed"][f"{kind}/{batch_item.obj['slug']}"] = batch_item.error
+            chunk.clear()
+        for item in read_dump(dump_dir, kind):
+            chunk.append(item)
+            if len(chunk) >= 500:
+                flush()
+        flush()
+        with wp_api.batch() as batch:
+            for (new_id, parent) in orphans.items():
+                if parent in id_maps[kind]:
+                    batch.post(f"wp/v2/{kind}/{new_id}", json={"parent": id_maps[kind][parent]}, obj=new_id)
+        for batch_item in batch.errors:
+            stats["failed"][f"{kind}/{batch_item.obj}"] = batch_item.error
+    return stats
@@ -1,12 +1,135 @@
+import atexit
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 from typing import Optional, Iterable
-from tempfile import TemporaryDirectory
 from datetime import datetime
 from uuid import uuid4
 
 import mistune
+import requests
 
-from .utils import from_datetime, to_datetime, download_file, is_dir, filehash
+from .utils import (from_datetime, to_datetime, download_file, is_dir, filehash, stream_hash, load_json, dump_json,
+                    guess_mime_type, ProgressReader, LazyData)
+
+HASH_CACHE_NAME = ".wpapi-media-hashes.json"
+SYNC_JOURNAL_NAME = ".wpapi-media-sync.json"
+JOURNAL_FLUSH_INTERVAL = 5.0
+DEDUP_INDEX_NAME = ".wpapi-media-index-{site}.json"
+
+def site_key(host):
+    # short, filename-safe id for a site, so per-site state doesn't mix across sites
+    return hashlib.sha1(host.rstrip("/").encode()).hexdigest()[:12]
+
+# stores with unsaved changes, held until flushed (at the latest, at exit)
+_open_stores = set()
+
+@atexit.register
+def _flush_stores():
+    for store in list(_open_stores):
+        try:
+            store.flush()
+        except OSError:
+            # e.g. the directory is gone; these are caches, so losing the last writes is harmless
+            pass
+
+class _JsonStore:
+    # a dict persisted as JSON, written at most every flush_interval seconds (and by flush() / at
+    # exit) rather than on every change, so N updates don't cost N full rewrites
+    flush_interval = 5.0
+
+    def __init__(self, path=None):
+        self.path = None if path is None else Path(path)
+        self.data = {} if path is None else load_json(self.path, default={})
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _changed(self):
+        # call with self._lock held
+        if self.path is None:
+            return
+        self._dirty = True
+        _open_stores.add(self)
+
+    def _maybe_flush(self):
+        if self._dirty and time.monotonic() - self._saved_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        # the snapshot is taken under the save lock, so a later write never loses to an earlier one
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                snapshot = dict(self.data)
+                self._dirty = False
+                self._saved_at = time.monotonic()
+                _open_stores.discard(self)
+            dump_json(self.path, snapshot)
+
+class MediaHashCache(_JsonStore):
+    # persistent hashes for the tiered WordPressMedia.in_sync check: remote hashes keyed by
+    # (media id, modified_gmt), local ones by (path, size, mtime); stats counts how each check was decided
+    def __init__(self, path=None):
+        super().__init__(path)
+        self.hashes = self.data
+        self.stats = {"size": 0, "cache": 0, "download": 0}
+
+    def get(self, key):
+        return self.hashes.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self.hashes[key] = value
+            self._changed()
+        self._maybe_flush()
+
+class MediaDedupIndex(_JsonStore):
+    # content hash (sha1) -> {id, url, size} of a remote media item holding those bytes, filled in by
+    # uploads and remote hash checks, so WordPressMedia.upload can reuse an item instead of re-sending it
+    algo = "sha1"
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self.entries = self.data
+        self._by_id = {entry["id"]: digest for (digest, entry) in self.entries.items()}
+        self.stats = {"hits": 0, "uploads": 0, "bytes_saved": 0}
+
+    def get(self, digest):
+        return self.entries.get(digest)
+
+    def add(self, digest, media_data, size=None):
+        media_id = media_data["id"]
+        if size is None:
+            size = media_data.get("media_details", {}).get("filesize")
+        with self._lock:
+            # an item holds one file, so whatever was indexed for it before is gone
+            old_digest = self._by_id.get(media_id)
+            if old_digest is not None and old_digest != digest:
+                self.entries.pop(old_digest, None)
+            replaced = self.entries.get(digest)
+            if replaced is not None and self._by_id.get(replaced["id"]) == digest:
+                del self._by_id[replaced["id"]]
+            self.entries[digest] = {"id": media_id, "url": media_data.get("source_url"), "size": size}
+            self._by_id[media_id] = digest
+            self._changed()
+        self._maybe_flush()
+
+    def discard(self, digest):
+        with self._lock:
+            entry = self.entries.pop(digest, None)
+            if entry is None:
+                return
+            if self._by_id.get(entry["id"]) == digest:
+                del self._by_id[entry["id"]]
+            self._changed()
+        self._maybe_flush()
 
 class WordPressMedia:
     # https://developer.wordpress.org/rest-api/reference/posts/
@@ -38,7 +161,7 @@ class WordPressMedia:
         new_metadata.update(with_metadata)
         wp_api = self.wp_api if wp_api is None else wp_api
         path = self.path if path is None else path
-        return WordPressMedia(path, new_metadata, wp_api=wp_api)
+        return type(self)(path, new_metadata, wp_api=wp_api)
 
     @property
     def url(self):
@@ -48,29 +171,72 @@ class WordPressMedia:
         path = self.path if to_path is None else Path(to_path)
         if path.exists() and not replace_existing:
             raise RuntimeError(f"File already exists at {path!r}: use replace_existing=True to overwrite.")
-        return download_file(self.url, path, **kwargs)
+        if self.wp_api is not None:
+            kwargs.setdefault("session", self.wp_api.session)
+        return download_file(self.url, path, overwrite=replace_existing, **kwargs)
     
     def local_hash(self, algo="sha1"):
-        return filehash(self.path, algo=algo)
+        hash_cache = self.hash_cache
+        stat = self.path.stat()
+        key = f"local:{self.path.resolve()}:{stat.st_size}:{stat.st_mtime}:{algo}"
+        result = hash_cache.get(key)
+        if result is None:
+            result = filehash(self.path, algo=algo)
+            hash_cache.set(key, result)
+        return result
     
     @property
     def local_mtime(self):
         return self.path.stat().st_mtime
 
+    @property
+    def remote_size(self):
+        # WordPress >= 6.0 reports the original's size; otherwise ask the file server
+        size = self.metadata.get("media_details", {}).get("filesize")
+        if size is None:
+            session = self.wp_api.session if self.wp_api is not None else None
+            r = (session or requests).head(self.url, allow_redirects=True)
+            r.raise_for_status()
+            size = r.headers.get("Content-Length")
+        return None if size is None else int(size)
+
     def remote_hash(self, algo="sha1", **kwargs):
-        with TemporaryDirectory() as tmpdir:
-            path = self.download(to_path=tmpdir, replace_existing=True, **kwargs)
-            return filehash(path, algo=algo)
+        hash_cache = self.hash_cache
+        # ids are only unique within a site
+        host = self.wp_api.host if self.wp_api is not None else self.url
+        key = f"remote:{site_key(host)}:{self.metadata['id']}:{self.metadata['modified_gmt']}:{algo}"
+        result = hash_cache.get(key)
+        if result is not None:
+            hash_cache.stats["cache"] += 1
+            return result
+        hash_cache.stats["download"] += 1
+        session = self.wp_api.session if self.wp_api is not None else None
+        result = stream_hash(self.url, algo=algo, session=session, **kwargs)
+        hash_cache.set(key, result)
+        if self.wp_api is not None and algo == MediaDedupIndex.algo:
+            self.wp_api.media_index.add(result, self.metadata)
+        return result
     
     @property
     def remote_mtime(self):
         return to_datetime(self.metadata["modified_gmt"]).timestamp()
 
+    @property
+    def hash_cache(self):
+        if self.wp_api is None:
+            return MediaHashCache()
+        return self.wp_api.media_hashes
+
     def __repr__(self):
         # ..?
         return f"<Media ...>"
 
     def in_sync(self, hash_algo="sha1"):
+        # cheapest check first: a size mismatch settles it without touching file contents
+        remote_size = self.remote_size
+        if remote_size is not None and remote_size != self.path.stat().st_size:
+            self.hash_cache.stats["size"] += 1
+            return False
         return self.local_hash(algo=hash_algo) == self.remote_hash(algo=hash_algo)
 
     def sync(self, check_sync=True):
@@ -82,28 +248,46 @@ class WordPressMedia:
         else:
             self.download(replace_existing=True)
 
-    def upload(self):
+    def save_metadata(self, fields=("title", "caption", "alt_text", "description"), batch=None):
+        # updates metadata only (no file transfer); rendered {"raw", "rendered"} values are sent as raw
+        assert self.wp_api is not None
+        body = {}
+        for field in fields:
+            if field not in self.metadata:
+                continue
+            value = self.metadata[field]
+            if isinstance(value, dict):
+                value = value.get("raw", value.get("rendered"))
+            body[field] = value
+        endpoint = f"wp/v2/media/{self.metadata['id']}"
+        if batch is not None:
+            return batch.post(endpoint, json=body, callback=self.metadata.update, obj=self)
+        result = self.wp_api.post(endpoint, json=body)
+        self.metadata.update(result)
+        return result
+
+    def upload(self, progress=None, dedup=True, update_metadata=True):
+        # progress, if given, is called as progress(bytes_sent, total_bytes) while the file streams.
+        # With dedup, bytes the media index already knows aren't sent again: the existing item is
+        # returned instead, with its metadata (title, caption, ...) updated if update_metadata
         assert self.wp_api is not None
         assert self.path.exists()
         existing_id = self.metadata.get("id")
         if existing_id is None:
-            existing_post = self.wp_api.media.get(self.metadata["slug"])
-            if existing_post is not None:
-                existing_id = existing_post.metadata["id"]
-            elif self.wp_api.debug:
+            existing_id = self.wp_api.media_slugs.get(self.metadata["slug"])
+            if existing_id is None and self.wp_api.debug:
                 print("none existing:", self.metadata["slug"])
+        digest = self.local_hash(algo=MediaDedupIndex.algo) if dedup else None
+        if digest is not None:
+            result = self._reuse(digest, existing_id, update_metadata)
+            if result is not None:
+                return result
         post_to_url = "wp/v2/media/"
         if existing_id is not None:
             if self.wp_api.debug:
                 print("updating existing:", existing_id)
             post_to_url += str(existing_id)
-        mime_type = {
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".png": "image/png",
-            ".svg": "image/svg+xml",
-            ".webp": "image/webp"
-        }[self.path.suffix.lower()]
+        mime_type = guess_mime_type(self.path)
         # doesn't work
         #result = self.wp_api.post(post_to_url, files={
         #    'upload_file': (self.path.name, self.path.open(mode="rb"), mime_type, {'Content-Disposition':'form-data'})})
@@ -112,28 +296,85 @@ class WordPressMedia:
             fname = f"{self.metadata['slug']}{self.path.suffix}"
         else:
             fname = self.path.name
-        result = self.wp_api.post(post_to_url,
-                                 data=self.path.open(mode="rb").read(),
-                                 headers={"Content-Type": "",
-                                          "Content-Disposition": f"attachment; filename={fname}"})
+        # the body is streamed from the open file, so memory use doesn't grow with file size
+        with self.path.open(mode="rb") as fp:
+            body = fp if progress is None else ProgressReader(fp, progress)
+            result = self.wp_api.post(post_to_url,
+                                     data=body,
+                                     headers={"Content-Type": mime_type,
+                                              "Content-Length": str(self.path.stat().st_size),
+                                              "Content-Disposition": f"attachment; filename={fname}"})
 
         #assert result["slug"] == self.metadata["slug"], f"Returned: {result!r}"
+        self.wp_api.media_slugs.add(result["slug"], result["id"])
+        if digest is not None:
+            self.wp_api.media_index.stats["uploads"] += 1
+            self.wp_api.media_index.add(digest, result, size=self.path.stat().st_size)
+        return result
+
+    def _reuse(self, digest, existing_id, update_metadata):
+        # the indexed item for these bytes, if it's the one being replaced (or none is) and still holds them
+        media_index = self.wp_api.media_index
+        entry = media_index.get(digest)
+        if entry is None or existing_id not in (None, entry["id"]):
+            return None
+        try:
+            result = self.wp_api.get(f"wp/v2/media/{entry['id']}")
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            # deleted on the site since it was indexed
+            media_index.discard(digest)
+            return None
+        # the file may have been replaced since (same id, other bytes): don't hand out the wrong one
+        size = result.get("media_details", {}).get("filesize")
+        if ((entry["url"] is not None and result.get("source_url") != entry["url"])
+                or (size is not None and size != self.path.stat().st_size)):
+            if self.wp_api.debug:
+                print("indexed item changed, uploading:", entry["id"])
+            media_index.discard(digest)
+            return None
+        if update_metadata:
+            result = self.copy(id=entry["id"]).save_metadata()
+        if self.wp_api.debug:
+            print("reusing existing:", entry["id"])
+        media_index.stats["hits"] += 1
+        media_index.stats["bytes_saved"] += self.path.stat().st_size
         return result
 
 class WordPressMediaProxy:
     # todo -- filtering, select by tags, setting, etc.
-    def __init__(self, wp_api, local_dir=None):
+    def __init__(self, wp_api, local_dir=None, fields=None):
         self.wp_api = wp_api
         self.local_dir = local_dir
+        self.fields = fields
+
+    def only(self, *fields):
+        # iterate with a _fields projection; other fields are loaded per item on first access.
+        # media_details is always kept, since it names the local file
+        required = ["id", "media_details"]
+        return WordPressMediaProxy(self.wp_api, self.local_dir,
+                                   fields=required + [field for field in fields if field not in required])
 
     def __iter__(self) -> Iterable[WordPressMedia]:
-        for media_data in self.wp_api.paged("wp/v2/media/"):
+        for media_data in self.wp_api.paged("wp/v2/media/", fields=self.fields):
+            if self.fields is not None:
+                media_data = LazyData(media_data, partial(self.wp_api.get, f"wp/v2/media/{media_data['id']}"))
             yield WordPressMedia(self.local_dir, media_data, wp_api=self.wp_api)
 
+    def index(self, **params):
+        # compact MediaRecords for the whole library, for large in-memory scans
+        from .records import MediaRecord
+        return [MediaRecord.from_json(media_data)
+                for media_data in self.wp_api.paged("wp/v2/media", fields=MediaRecord.fields, **params)]
+
     def get(self, key, local_dir=None) -> Optional[WordPressMedia]:
         if isinstance(key, str):
             slug = key
-            media = list(self.wp_api.paged("wp/v2/media", slug=slug, nocache=str(uuid4())))
+            params = {"slug": slug}
+            if self.wp_api.cache is None:
+                params["nocache"] = str(uuid4())
+            media = list(self.wp_api.paged("wp/v2/media", **params))
             if not media:
                 return None
             if self.wp_api.debug and len(media) > 1:
@@ -147,6 +388,10 @@ class WordPressMediaProxy:
             media_data = self.wp_api.get(f"wp/v2/media/{id_}")
         return WordPressMedia(local_dir, media_data, wp_api=self.wp_api)
 
+    def slug_ids(self, slugs):
+        # bulk slug -> id (None if missing) resolution, shared with WordPressMedia.upload
+        return self.wp_api.media_slugs.prefetch(slugs)
+
     def __getitem__(self, key) -> WordPressMedia:
         if isinstance(key, (str, int)):
             result = self.get(key)
@@ -160,3 +405,96 @@ class WordPressMediaProxy:
     def __setitem__(self, slug, media: WordPressMedia):
         slugged_media = media.copy(slug=slug, wp_api=self.wp_api)
         slugged_media.upload()
+
+    def sync_directory(self, local_dir=None, max_workers=None, upload=True, download=True):
+        # mirrors the whole library against local_dir: lists the remote once, matches local files by
+        # slug or filename, and transfers whichever side is newer in a thread pool. Completed items
+        # go to a journal in local_dir, so an interrupted run skips them next time.
+        local_dir = Path(self.local_dir if local_dir is None else local_dir)
+        max_workers = self.wp_api.max_workers if max_workers is None else max_workers
+        journal_path = local_dir / SYNC_JOURNAL_NAME
+        journal = load_json(journal_path, default={})
+        metrics = self.wp_api.metrics
+        remote_by_name = {}
+        with metrics.timer("media_sync.list"):
+            for media in WordPressMediaProxy(self.wp_api, local_dir).only("slug", "modified_gmt", "source_url"):
+                remote_by_name[media.path.name] = media
+                remote_by_name.setdefault(media.metadata["slug"], media)
+        tasks = []
+        matched = set()
+        for p in sorted(local_dir.iterdir()):
+            # dotfiles include download_file's partial files; bare .part ones are from older versions
+            if p.name.startswith(".") or p.name.endswith((".part", ".part.json")) or not p.is_file():
+                continue
+            media = remote_by_name.get(p.name, remote_by_name.get(p.stem))
+            if media is None:
+                if upload:
+                    tasks.append((p, None))
+                continue
+            matched.add(media.metadata["id"])
+            record = journal.get(p.name)
+            if record is not None and record == _journal_record(p, media.metadata):
+                continue
+            tasks.append((p, media.copy(path=p)))
+        if download:
+            for media in remote_by_name.values():
+                if media.metadata["id"] not in matched and not media.path.exists():
+                    matched.add(media.metadata["id"])
+                    tasks.append((media.path, media))
+
+        stats = {"uploaded": 0, "downloaded": 0, "unchanged": 0, "skipped": 0, "failed": {}, "bytes": 0}
+        start = saved_at = time.monotonic()
+        try:
+            with metrics.timer("media_sync.transfer"), ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(self._sync_one, p, media, upload, download): p for (p, media) in tasks}
+                for future in as_completed(futures):
+                    p = futures[future]
+                    try:
+                        action, metadata = future.result()
+                    except Exception as e:
+                        stats["failed"][p.name] = repr(e)
+                        continue
+                    stats[action] += 1
+                    if action in ("uploaded", "downloaded"):
+                        stats["bytes"] += p.stat().st_size
+                    journal[p.name] = _journal_record(p, metadata)
+                    # written every few seconds, and once more below however the run ends
+                    if time.monotonic() - saved_at >= JOURNAL_FLUSH_INTERVAL:
+                        dump_json(journal_path, journal)
+                        saved_at = time.monotonic()
+        finally:
+            dump_json(journal_path, journal)
+            self.wp_api.media_hashes.flush()
+            self.wp_api.media_index.flush()
+        stats["seconds"] = elapsed = time.monotonic() - start
+        stats["bytes_per_sec"] = stats["bytes"] / elapsed if elapsed else 0.0
+        stats["items_per_sec"] = len(tasks) / elapsed if elapsed else 0.0
+        return stats
+
+    def _sync_one(self, path, media, upload, download):
+        metrics = self.wp_api.metrics
+        if media is None:
+            with metrics.timer("media_sync.upload"):
+                result = WordPressMedia.from_file(path, {"slug": path.stem}, wp_api=self.wp_api).upload()
+            return "uploaded", result
+        if path.exists():
+            with metrics.timer("media_sync.check"):
+                in_sync = media.in_sync()
+            if in_sync:
+                return "unchanged", media.metadata
+            if media.local_mtime > media.remote_mtime:
+                if not upload:
+                    return "skipped", media.metadata
+                with metrics.timer("media_sync.upload"):
+                    return "uploaded", media.upload()
+            if not download:
+                return "skipped", media.metadata
+        with metrics.timer("media_sync.download"):
+            media.download(replace_existing=True)
+        # stamp the file with the remote time, or the next run would see it as a newer local copy
+        os.utime(path, (media.remote_mtime, media.remote_mtime))
+        return "downloaded", media.metadata
+
+def _journal_record(path, metadata):
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "id": metadata["id"], "modified_gmt": metadata["modified_gmt"]}
@@ -0,0 +1,80 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets; the last bucket is everything slower
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+def endpoint_key(endpoint):
+    # wp/v2/posts/123 -> wp/v2/posts/<id>, so per-object requests aggregate together
+    return re.sub(r"/\d+(?=/|$)", "/<id>", endpoint.strip("/")) or "/"
+
+class RequestMetrics:
+    # per (method, endpoint) request counts, latency histogram, bytes, status codes and retries,
+    # plus named phase timers; callbacks get every event as a dict, e.g. to forward to statsd
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.callbacks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.phases = {}
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def _emit(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+    def _stats(self, method, endpoint):
+        key = (method, endpoint_key(endpoint))
+        stats = self.requests.get(key)
+        if stats is None:
+            stats = self.requests[key] = {
+                "count": 0, "seconds": 0.0, "latency": [0] * (len(LATENCY_BUCKETS) + 1),
+                "bytes_in": 0, "bytes_out": 0, "status": {}, "retries": 0}
+        return stats
+
+    def record(self, method, endpoint, seconds, status, bytes_in=0, bytes_out=0):
+        with self._lock:
+            stats = self._stats(method, endpoint)
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["latency"][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["status"][status] = stats["status"].get(status, 0) + 1
+        self._emit({"type": "request", "method": method, "endpoint": endpoint_key(endpoint), "seconds": seconds,
+                    "status": status, "bytes_in": bytes_in, "bytes_out": bytes_out})
+
+    def record_retry(self, method, endpoint, reason=None):
+        with self._lock:
+            self._stats(method, endpoint)["retries"] += 1
+        self._emit({"type": "retry", "method": method, "endpoint": endpoint_key(endpoint), "reason": reason})
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                stats = self.phases.setdefault(phase, {"count": 0, "seconds": 0.0})
+                stats["count"] += 1
+                stats["seconds"] += seconds
+            self._emit({"type": "phase", "phase": phase, "seconds": seconds})
+
+    def summary(self):
+        with self._lock:
+            requests = {f"{method} {endpoint}": dict(stats, status=dict(stats["status"]), latency=list(stats["latency"]))
+                        for ((method, endpoint), stats) in sorted(self.requests.items())}
+            phases = {phase: dict(stats) for (phase, stats) in self.phases.items()}
+        return {"requests": requests, "phases": phases, "latency_buckets": LATENCY_BUCKETS + [float("inf")],
+                "total_requests": sum(stats["count"] for stats in requests.values()),
+                "total_seconds": sum(stats["seconds"] for stats in requests.values())}
@@ -1,40 +1,70 @@
+import threading
+from functools import partial
 from typing import Optional, Iterable
 
 import mistune
 
-from .utils import from_datetime, to_datetime
+from .utils import from_datetime, to_datetime, LazyData
+from .slugs import POST_STATUSES
+
+_local = threading.local()
+
+def preserve_leading_spaces(markdown):
+    # keeps indentation (e.g. verse) by turning each line's leading spaces into non-breaking ones
+    lines = []
+    for line in markdown.split("\n"):
+        stripped = line.lstrip(" ")
+        lines.append("&nbsp;" * (len(line) - len(stripped)) + stripped)
+    return "\n".join(lines)
+
+# front matter `preprocess: name[,name...]` -> function applied to the markdown before rendering
+PREPROCESSORS = {"leading_spaces": preserve_leading_spaces}
+
+def render_markdown(markdown, preprocess=""):
+    # module-level so it can run in a process pool; each thread / process reuses one renderer
+    for preprocessor in preprocess.split(","):
+        if not preprocessor:
+            continue
+        if preprocessor not in PREPROCESSORS:
+            raise ValueError(f"Unknown preprocessor: {preprocessor!r}")
+        markdown = PREPROCESSORS[preprocessor](markdown)
+    renderer = getattr(_local, "renderer", None)
+    if renderer is None:
+        # create_markdown has the HTML renderer (a bare mistune.Markdown() returns AST tokens);
+        # escape=False lets inline HTML in posts through, as WordPress expects
+        renderer = _local.renderer = mistune.create_markdown(escape=False)
+    html = renderer(markdown)
+    assert isinstance(html, str), f"Markdown rendered to {type(html).__name__}, not HTML"
+    return html
 
 class WordPressPost:
     # https://developer.wordpress.org/rest-api/reference/posts/
     @classmethod
-    def from_markdown(cls, metadata, markdown, *, wp_api=None):
+    def from_markdown(cls, metadata, markdown, *, wp_api=None, html=None):
+        # html, if given, is markdown already rendered (e.g. by sync's render pool or cache)
         data = dict(metadata)
         data["date"] = from_datetime(data["date"])
         data["modified"] = from_datetime(data.get("modified", data["date"]))
+        # categories / tags are names; category_ids / tag_ids are ids kept as-is (as pulled when
+        # the term couldn't be named)
+        cat_ids = set(int(cat_id) for cat_id in data.pop("category_ids", []))
         if "categories" in data:
             assert wp_api is not None
             categories = set(cat.strip() for cat in data["categories"].split(","))
-            cat_ids = wp_api.category_ids(categories, create_if_missing=True)
+            cat_ids |= wp_api.category_ids(categories, create_if_missing=True)
+        if cat_ids:
             data["categories"] = ",".join([str(cat_id) for cat_id in cat_ids])
+        tag_ids = set(int(tag_id) for tag_id in data.pop("tag_ids", []))
         if "tags" in data:
             assert wp_api is not None
             tags = set(cat.strip() for cat in data["tags"].split(","))
-            tag_ids = wp_api.tag_ids(tags, create_if_missing=True)
-            data["tags"] = ",".join([str(tag_id) for tag_id in tag_ids])
-            for new_tag in tags:
-                new_t = wp_api.post("wp/v2/tags", json={"name": new_tag})
-                tag_ids.add(new_t["id"])
+            tag_ids |= wp_api.tag_ids(tags, create_if_missing=True)
+        if tag_ids:
             data["tags"] = ",".join([str(tag_id) for tag_id in tag_ids])
-        for preprocessor in data.pop("preprocess", "").split(","):
-            if not preprocessor:
-                continue
-            if preprocessor == "leading_spaces":
-                print("adding leading spaces...")
-                markdown = preserve_leading_spaces(markdown)
-            else:
-                raise ValueError(f"Unknown preprocessor: {preprocessor!r}")
-        md = mistune.Markdown()
-        html = md(markdown)
+        preprocess = data.pop("preprocess", "")
+        if html is None:
+            html = render_markdown(markdown, preprocess)
+        assert isinstance(html, str), f"Post content must be HTML, not {type(html).__name__}"
         data["content"] = html
         return cls(data, wp_api=wp_api)
 
@@ -46,7 +76,7 @@ class WordPressPost:
         new_data = self.data.copy()
         new_data.update(with_data)
         wp_api = self.wp_api if wp_api is None else wp_api
-        return WordPressPost(new_data, wp_api=wp_api)
+        return type(self)(new_data, wp_api=wp_api)
 
     def __repr__(self):
         title = self.data["title"]["rendered"]
@@ -56,42 +86,65 @@ class WordPressPost:
         on = created if created == modified else f"{created} ({modified})"
         return f"<Post {title!r} by {author} on {on}>"
 
-    def save(self):
+    def save(self, batch=None):
+        # with a batch (wp_api.batch()), the write is queued and the BatchItem returned instead
         assert self.wp_api is not None
         existing_id = self.data.get("id")
         if existing_id is None:
-            existing_post = self.wp_api.posts.get(self.data["slug"])
-            if existing_post is not None:
-                existing_id = existing_post.data["id"]
-            elif self.wp_api.debug:
+            existing_id = self.wp_api.post_slugs.get(self.data["slug"])
+            if existing_id is None and self.wp_api.debug:
                 print("none existing:", self.data["slug"])
         post_to_url = "wp/v2/posts/"
         if existing_id is not None:
             if self.wp_api.debug:
                 print("updating existing:", existing_id)
             post_to_url += str(existing_id)
+        if batch is not None:
+            return batch.post(post_to_url, json=self.data, callback=self._saved, obj=self)
         result = self.wp_api.post(post_to_url, json=self.data)
+        self._saved(result)
+        return result
+
+    def _saved(self, result):
         assert result["slug"] == self.data["slug"]
+        self.wp_api.post_slugs.add(result["slug"], result["id"])
 
 class WordPressPostsProxy:
     # todo -- filtering, select by tags, setting, etc.
-    def __init__(self, wp_api):
+    def __init__(self, wp_api, fields=None):
         self.wp_api = wp_api
+        self.fields = fields
+
+    def only(self, *fields):
+        # iterate with a _fields projection; other fields are loaded per post on first access
+        return WordPressPostsProxy(self.wp_api, fields=["id"] + [field for field in fields if field != "id"])
 
     def __iter__(self) -> Iterable[WordPressPost]:
-        for post_data in self.wp_api.paged("wp/v2/posts"):
+        for post_data in self.wp_api.paged("wp/v2/posts", fields=self.fields):
+            if self.fields is not None:
+                post_data = LazyData(post_data, partial(self.wp_api.get, f"wp/v2/posts/{post_data['id']}"))
             yield WordPressPost(post_data, wp_api=self.wp_api)
 
+    def index(self, **params):
+        # compact PostRecords for every post (all statuses unless given), for large in-memory scans
+        from .records import PostRecord
+        params.setdefault("status", ",".join(POST_STATUSES))
+        return [PostRecord.from_json(post_data)
+                for post_data in self.wp_api.paged("wp/v2/posts", fields=PostRecord.fields, **params)]
+
     def get(self, slug) -> Optional[WordPressPost]:
-        # have to check every status :eyeroll:
-        for status in ["publish", "future", "draft", "pending", "private"]:
-            posts = list(self.wp_api.paged("wp/v2/posts", slug=slug, status=status))
-            if posts:
-                if self.wp_api.debug and len(posts) > 1:
-                    print(posts)
-                assert len(posts) == 1
-                return WordPressPost(posts[0], wp_api=self.wp_api)
-        return None
+        # have to ask for every status explicitly, or only published posts come back
+        posts = list(self.wp_api.paged("wp/v2/posts", slug=slug, status=",".join(POST_STATUSES)))
+        if not posts:
+            return None
+        if self.wp_api.debug and len(posts) > 1:
+            print(posts)
+        assert len(posts) == 1
+        return WordPressPost(posts[0], wp_api=self.wp_api)
+
+    def slug_ids(self, slugs):
+        # bulk slug -> id (None if missing) resolution, shared with WordPressPost.save
+        return self.wp_api.post_slugs.prefetch(slugs)
 
     def __getitem__(self, slug) -> WordPressPost:
         # todo -- allow key to be post_id, or date range
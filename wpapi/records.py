@@ -0,0 +1,88 @@
+import sys
+import time
+from calendar import timegm
+from functools import partial
+from pathlib import Path
+
+from .utils import LazyData, WP_DATETIME_FMT
+from .posts import WordPressPost
+from .media import WordPressMedia
+
+def gmt_timestamp(value):
+    # WordPress *_gmt strings are fixed-width, so slicing beats strptime by a wide margin
+    if not value:
+        return None
+    return timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                   int(value[11:13]), int(value[14:16]), int(value[17:19])))
+
+def gmt_string(timestamp):
+    if timestamp is None:
+        return None
+    return time.strftime(WP_DATETIME_FMT, time.gmtime(timestamp))
+
+class PostRecord:
+    # compact listing entry for whole-site indexes: no per-object dict, shared status/type strings,
+    # and GMT dates as epoch seconds, so sorting / filtering by date is plain number comparison
+    __slots__ = ("id", "slug", "status", "type", "modified", "date")
+    endpoint = "wp/v2/posts"
+    fields = ["id", "slug", "status", "type", "modified_gmt", "date_gmt"]
+
+    def __init__(self, id, slug, status, type, modified, date):
+        self.id = id
+        self.slug = slug
+        self.status = status
+        self.type = type
+        self.modified = modified
+        self.date = date
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["slug"], sys.intern(data["status"]), sys.intern(data.get("type", "post")),
+                   gmt_timestamp(data["modified_gmt"]), gmt_timestamp(data.get("date_gmt")))
+
+    def to_json(self):
+        return {"id": self.id, "slug": self.slug, "status": self.status, "type": self.type,
+                "modified_gmt": gmt_string(self.modified), "date_gmt": gmt_string(self.date)}
+
+    def to_post(self, wp_api):
+        # fields beyond the record are fetched on first access
+        return WordPressPost(LazyData(self.to_json(), partial(wp_api.get, f"{self.endpoint}/{self.id}")), wp_api=wp_api)
+
+    def __repr__(self):
+        return f"<PostRecord {self.id} {self.slug!r} {self.status} modified {gmt_string(self.modified)}>"
+
+class MediaRecord:
+    __slots__ = ("id", "slug", "status", "mime_type", "modified", "date", "source_url")
+    endpoint = "wp/v2/media"
+    fields = ["id", "slug", "status", "mime_type", "modified_gmt", "date_gmt", "source_url"]
+
+    def __init__(self, id, slug, status, mime_type, modified, date, source_url):
+        self.id = id
+        self.slug = slug
+        self.status = status
+        self.mime_type = mime_type
+        self.modified = modified
+        self.date = date
+        self.source_url = source_url
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["slug"], sys.intern(data["status"]), sys.intern(data["mime_type"]),
+                   gmt_timestamp(data["modified_gmt"]), gmt_timestamp(data.get("date_gmt")), data["source_url"])
+
+    def to_json(self):
+        return {"id": self.id, "slug": self.slug, "status": self.status, "mime_type": self.mime_type,
+                "modified_gmt": gmt_string(self.modified), "date_gmt": gmt_string(self.date),
+                "source_url": self.source_url}
+
+    @property
+    def filename(self):
+        return self.source_url.split("/")[-1]
+
+    def to_media(self, wp_api, local_dir=None):
+        local_dir = wp_api.media_dir if local_dir is None else local_dir
+        metadata = LazyData(self.to_json(), partial(wp_api.get, f"{self.endpoint}/{self.id}"))
+        return WordPressMedia(Path(local_dir) / self.filename, metadata, wp_api=wp_api)
+
+    def __repr__(self):
+        return f"<MediaRecord {self.id} {self.slug!r} {self.mime_type} modified {gmt_string(self.modified)}>"
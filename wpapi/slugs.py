@@ -0,0 +1,50 @@
+import threading
+
+POST_STATUSES = ["publish", "future", "draft", "pending", "private"]
+MEDIA_STATUSES = ["inherit", "private"]
+
+class SlugIndex:
+    # slug -> id map for one endpoint, filled in bulk with multi-valued slug[] filters across all
+    # statuses; shared by the save/upload paths so a batch of objects costs a handful of requests
+    def __init__(self, wp_api, endpoint, statuses, chunk_size=50):
+        self.wp_api = wp_api
+        self.endpoint = endpoint
+        self.statuses = statuses
+        # slugs per request; keeps the query string well under common 8k URL limits
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._ids = {}
+            self._missing = set()
+
+    def prefetch(self, slugs):
+        with self._lock:
+            todo = sorted(set(slug for slug in slugs if slug not in self._ids and slug not in self._missing))
+        for i in range(0, len(todo), self.chunk_size):
+            chunk = todo[i:i + self.chunk_size]
+            found = {}
+            for item in self.wp_api.paged(self.endpoint, status=",".join(self.statuses),
+                                          _fields="id,slug,status", **{"slug[]": chunk}):
+                found[item["slug"]] = item["id"]
+            with self._lock:
+                self._ids.update(found)
+                self._missing.update(slug for slug in chunk if slug not in found)
+        return {slug: self._ids.get(slug) for slug in slugs}
+
+    def get(self, slug):
+        if slug not in self._ids and slug not in self._missing:
+            self.prefetch([slug])
+        return self._ids.get(slug)
+
+    def add(self, slug, id_):
+        with self._lock:
+            self._ids[slug] = id_
+            self._missing.discard(slug)
+
+    def discard(self, slug):
+        with self._lock:
+            self._ids.pop(slug, None)
+            self._missing.discard(slug)
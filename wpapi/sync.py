@@ -1,15 +1,425 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
 from pathlib import Path
 
 import frontmatter
+import requests
 
-from .posts import WordPressPost
+from .posts import WordPressPost, render_markdown, PREPROCESSORS
+from .media import WordPressMedia
+from .slugs import POST_STATUSES, MEDIA_STATUSES
+from .utils import filehash, load_json, dump_json, to_datetime, from_datetime
 
-def sync_markdown_directory(dir_path, wp_api):
-    for p in Path(dir_path).iterdir():
-        if p.suffix.lower() == ".md":
-            post = frontmatter.load(p.open())
-            metadata = dict(post.metadata)
+MANIFEST_NAME = ".wpapi-sync.json"
+RENDER_CACHE_NAME = ".wpapi-render-cache.json"
+
+class SyncManifest:
+    # per-file record of what was last pushed: content hash, mtime, remote post id and remote modified,
+    # kept per site (host), since ids and "already pushed" mean nothing on another site
+    def __init__(self, path, host):
+        self.path = Path(path)
+        data = load_json(self.path, default={})
+        # manifests from before per-site entries don't say which site they were for, so start over
+        self.sites = data.get("sites", {})
+        self.entries = self.sites.setdefault(host, {})
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def is_unchanged(self, p):
+        # mtime match is enough to skip without reading the file; otherwise fall back to the hash
+        entry = self.entries.get(p.name)
+        if entry is None:
+            return False
+        mtime = p.stat().st_mtime
+        if entry["mtime"] == mtime:
+            return True
+        if entry["hash"] == filehash(p):
+            entry["mtime"] = mtime
+            return True
+        return False
+
+    def record(self, p, result):
+        self.entries[p.name] = {
+            "hash": filehash(p),
+            "mtime": p.stat().st_mtime,
+            "id": result["id"],
+            "modified": result.get("modified_gmt", result.get("modified")),
+        }
+
+    def save(self):
+        dump_json(self.path, {"sites": self.sites})
+
+class RenderCache:
+    # rendered HTML keyed by a hash of the markdown source and its preprocessors
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = load_json(self.path, default={})
+        self.used = set()
+
+    @staticmethod
+    def key(markdown, preprocess=""):
+        return hashlib.sha1(f"{preprocess}\0{markdown}".encode()).hexdigest()
+
+    def get(self, key):
+        html = self.entries.get(key)
+        if not isinstance(html, str):
+            # missing, or written by a version that cached mistune's AST tokens
+            return None
+        self.used.add(key)
+        return html
+
+    def set(self, key, html):
+        self.entries[key] = html
+        self.used.add(key)
+
+    def save(self, prune=False):
+        # prune drops entries not used this run, so the cache tracks the current sources
+        if prune:
+            self.entries = {key: html for (key, html) in self.entries.items() if key in self.used}
+        dump_json(self.path, self.entries)
+
+def render_all(sources, render_cache=None, render_workers=None):
+    # yields (item, html) for each (item, markdown, preprocess): cache hits first, then the rest as a
+    # process pool finishes rendering them, so the caller's network writes overlap the rendering
+    to_render = []
+    for (item, markdown, preprocess) in sources:
+        key = RenderCache.key(markdown, preprocess)
+        html = render_cache.get(key) if render_cache is not None else None
+        if html is None:
+            to_render.append((item, markdown, preprocess, key))
+        else:
+            yield item, html
+    render_workers = os.cpu_count() if render_workers is None else render_workers
+    if render_workers <= 1 or len(to_render) < 2:
+        for (item, markdown, preprocess, key) in to_render:
+            html = render_markdown(markdown, preprocess)
+            if render_cache is not None:
+                render_cache.set(key, html)
+            yield item, html
+        return
+    with ProcessPoolExecutor(max_workers=min(render_workers, len(to_render))) as executor:
+        futures = {executor.submit(render_markdown, markdown, preprocess): (item, key)
+                   for (item, markdown, preprocess, key) in to_render}
+        for future in as_completed(futures):
+            item, key = futures[future]
+            html = future.result()
+            if render_cache is not None:
+                render_cache.set(key, html)
+            yield item, html
+
+def sync_markdown_directory(dir_path, wp_api, use_manifest=True, force=False, batch_writes=True,
+                            render_workers=None):
+    # stages: scan (skipping files unchanged since the manifest) -> parse -> render in a process pool
+    # (or from the render cache) -> queue writes, which go out in batches while rendering continues
+    dir_path = Path(dir_path)
+    manifest = SyncManifest(dir_path / MANIFEST_NAME, wp_api.host) if use_manifest else None
+    render_cache = RenderCache(dir_path / RENDER_CACHE_NAME) if use_manifest else None
+    paths = [p for p in sorted(dir_path.iterdir()) if p.suffix.lower() == ".md"]
+    failed = _sync_paths(paths, wp_api, manifest, render_cache, force=force, batch_writes=batch_writes,
+                         render_workers=render_workers)
+    if render_cache is not None:
+        # a forced run renders every source, so stale entries can be dropped
+        render_cache.save(prune=force)
+    if manifest is not None:
+        manifest.save()
+    if failed:
+        raise RuntimeError(f"Failed to sync {len(failed)} file(s) in {dir_path}: {failed!r}")
+
+def _sync_paths(paths, wp_api, manifest, render_cache, force=False, batch_writes=True, render_workers=None):
+    # pushes the given markdown files, recording successes in the manifest; returns {name: error}
+    # files that can't be parsed or turned into a post are reported in the result, not raised,
+    # so one bad (or half-saved) file doesn't stop the rest, or a long-running watch
+    metrics = wp_api.metrics
+    changed = []
+    failed = {}
+    with metrics.timer("sync.scan"):
+        for p in paths:
+            try:
+                if not p.exists() or (manifest is not None and not force and manifest.is_unchanged(p)):
+                    continue
+                with p.open() as fp:
+                    post = frontmatter.load(fp)
+                metadata = dict(post.metadata)
+                if "date" not in metadata:
+                    raise ValueError("no date in front matter")
+                for preprocessor in metadata.get("preprocess", "").split(","):
+                    if preprocessor and preprocessor not in PREPROCESSORS:
+                        raise ValueError(f"Unknown preprocessor: {preprocessor!r}")
+            except Exception as e:
+                failed[p.name] = f"{type(e).__name__}: {e}"
+                continue
             metadata.setdefault("slug", p.stem)
             metadata.setdefault("status", "publish")
-            wp_post = WordPressPost.from_markdown(metadata, post.content, wp_api=wp_api)
-            wp_post.save()
+            entry = manifest.get(p.name) if manifest is not None else None
+            if entry is not None:
+                metadata.setdefault("id", entry["id"])
+            changed.append((p, metadata, post.content))
+    # resolve every post's slug up front in a few bulk requests, rather than one probe per save. A
+    # known id (from the manifest or the front matter) is only trusted if the site agrees it is this
+    # slug's post; otherwise the save goes by slug, so a stale id can't overwrite an unrelated post
+    with metrics.timer("sync.slugs"):
+        slug_ids = wp_api.post_slugs.prefetch([metadata["slug"] for (p, metadata, content) in changed])
+    for (p, metadata, content) in changed:
+        if "id" in metadata and slug_ids[metadata["slug"]] != metadata["id"]:
+            if wp_api.debug:
+                print(f"{p.name}: post {metadata['id']} isn't {metadata['slug']!r} on {wp_api.host}; saving by slug")
+            del metadata["id"]
+    sources = [((p, metadata), content, metadata.get("preprocess", "")) for (p, metadata, content) in changed]
+    # max_size=0 sends the queued writes one request at a time, with the same per-item error handling
+    queued = []
+    with metrics.timer("sync.render_write"), wp_api.batch(max_size=None if batch_writes else 0) as batch:
+        for ((p, metadata), html) in render_all(sources, render_cache, render_workers):
+            try:
+                post = WordPressPost.from_markdown(metadata, None, wp_api=wp_api, html=html)
+            except requests.RequestException:
+                # the site, not the file; left to the caller (watch mode retries these)
+                raise
+            except Exception as e:
+                failed[p.name] = f"{type(e).__name__}: {e}"
+                continue
+            queued.append((p, post.save(batch=batch)))
+    for (p, item) in queued:
+        if not item.ok and item.status == 404 and "id" in item.obj.data:
+            # the post we pushed last time was deleted remotely; fall back to a slug lookup
+            del item.obj.data["id"]
+            wp_api.post_slugs.discard(item.obj.data["slug"])
+            try:
+                result = item.obj.save()
+            except requests.HTTPError as e:
+                failed[p.name] = str(e)
+                continue
+        elif not item.ok:
+            failed[p.name] = item.error
+            continue
+        else:
+            result = item.result
+        if manifest is not None:
+            manifest.record(p, result)
+    return failed
+
+class _PollingWatcher:
+    # mtime / size snapshot of the directory's markdown files, refreshed with one scandir per poll
+    def __init__(self, dir_path):
+        self.dir_path = Path(dir_path)
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        with os.scandir(self.dir_path) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(".md") and entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        snapshot, self.snapshot = self.snapshot, self.scan()
+        return {self.dir_path / name for (name, stat) in self.snapshot.items() if snapshot.get(name) != stat}
+
+    def close(self):
+        pass
+
+class _InotifyWatcher:
+    # close-after-write and rename-into events, so editors' save-via-rename is picked up too
+    def __init__(self, dir_path):
+        from inotify_simple import INotify, flags
+        self.dir_path = Path(dir_path)
+        self.inotify = INotify()
+        self.inotify.add_watch(self.dir_path, flags.CLOSE_WRITE | flags.MOVED_TO)
+
+    def changes(self, timeout):
+        return {self.dir_path / event.name for event in self.inotify.read(timeout=int(timeout * 1000))
+                if event.name.lower().endswith(".md")}
+
+    def close(self):
+        self.inotify.close()
+
+def _watcher(dir_path, use_inotify=None):
+    if use_inotify is not False:
+        try:
+            return _InotifyWatcher(dir_path)
+        except (ImportError, OSError):
+            if use_inotify:
+                raise
+    return _PollingWatcher(dir_path)
+
+def watch_markdown_directory(dir_path, wp_api, debounce=0.25, poll_interval=0.5, use_manifest=True,
+                             batch_writes=True, initial_sync=True, use_inotify=None, on_sync=None, stop=None):
+    # Long-running sync_markdown_directory: after one initial pass, waits for files to change (inotify
+    # when inotify_simple is installed, otherwise mtime polling) and pushes just those, once a burst of
+    # edits has been quiet for `debounce` seconds. wp_api keeps its session, term indexes and slug index
+    # warm between pushes, and the manifest / render cache stay in memory. Runs until `stop` (a
+    # threading.Event) is set or KeyboardInterrupt; on_sync(names, failed) is called after each push.
+    dir_path = Path(dir_path)
+    manifest = SyncManifest(dir_path / MANIFEST_NAME, wp_api.host) if use_manifest else None
+    render_cache = RenderCache(dir_path / RENDER_CACHE_NAME) if use_manifest else None
+    watcher = _watcher(dir_path, use_inotify)
+    stats = {"pushes": 0, "files": 0, "failed": {}}
+
+    def push(paths):
+        failed = _sync_paths(sorted(paths), wp_api, manifest, render_cache, batch_writes=batch_writes,
+                             render_workers=1 if len(paths) < 8 else None)
+        if render_cache is not None:
+            render_cache.save()
+        if manifest is not None:
+            manifest.save()
+        names = sorted(p.name for p in paths)
+        stats["pushes"] += 1
+        stats["files"] += len(names)
+        for name in names:
+            stats["failed"].pop(name, None)
+        stats["failed"].update(failed)
+        if wp_api.debug:
+            print(f"Synced {names}" + (f", failed {failed!r}" if failed else ""))
+        if on_sync is not None:
+            on_sync(names, failed)
+
+    pending = set()
+    deadline = None
+    try:
+        if initial_sync:
+            push([p for p in sorted(dir_path.iterdir()) if p.suffix.lower() == ".md"])
+        while stop is None or not stop.is_set():
+            timeout = poll_interval if deadline is None else max(0, deadline - time.monotonic())
+            changes = watcher.changes(timeout)
+            if changes:
+                pending |= changes
+                deadline = time.monotonic() + debounce
+            elif pending and time.monotonic() >= deadline:
+                paths, pending, deadline = pending, set(), None
+                try:
+                    push(paths)
+                except requests.RequestException as e:
+                    # the site is unreachable or erroring; keep the files queued and try again later
+                    if wp_api.debug:
+                        print(f"Sync of {sorted(p.name for p in paths)} failed, retrying: {e!r}")
+                    pending |= paths
+                    deadline = time.monotonic() + max(poll_interval, 5 * debounce)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return stats
+
+PULL_STATE_NAME = ".wpapi-pull.json"
+
+def _changed_since(wp_api, endpoint, statuses, state):
+    # items modified after the stored high-water mark, oldest first; the mark is WordPress's local
+    # `modified` time, since that's the column modified_after filters on. It is backed off a second
+    # so edits landing in the same second as the last pull aren't missed; the ids already pulled
+    # at exactly the mark are skipped
+    params = {"status": ",".join(statuses), "orderby": "modified", "order": "asc", "context": "edit"}
+    high_water = state.get("high_water")
+    seen = set(state.get("at_high_water", []))
+    if high_water:
+        params["modified_after"] = from_datetime(to_datetime(high_water) - timedelta(seconds=1))
+    for item in wp_api.paged(endpoint, **params):
+        if high_water is not None and item["modified"] == high_water and item["id"] in seen:
+            continue
+        if high_water is None or item["modified"] > high_water:
+            high_water = item["modified"]
+            seen = set()
+        if item["modified"] == high_water:
+            seen.add(item["id"])
+        state["high_water"] = high_water
+        state["at_high_water"] = sorted(seen)
+        yield item
+
+def _rendered_or_raw(value):
+    if isinstance(value, dict):
+        return value.get("raw", value.get("rendered", ""))
+    return value
+
+def _post_frontmatter(wp_api, post_data):
+    metadata = {
+        "id": post_data["id"],
+        "title": _rendered_or_raw(post_data["title"]),
+        "slug": post_data["slug"],
+        "status": post_data["status"],
+        "date": post_data["date"],
+        "modified": post_data["modified"],
+    }
+    for key, ids_key, index in [("categories", "category_ids", wp_api.category_index),
+                                ("tags", "tag_ids", wp_api.tag_index)]:
+        term_ids = post_data.get(key)
+        if not term_ids:
+            continue
+        names = index.names(term_ids)
+        if names:
+            metadata[key] = ", ".join(names)
+        # terms we can't name are kept by id, which from_markdown passes through
+        unknown = [term_id for term_id in term_ids if index.name(term_id) is None]
+        if unknown:
+            metadata[ids_key] = unknown
+    return frontmatter.dumps(frontmatter.Post(_rendered_or_raw(post_data["content"]), **metadata))
+
+def _replace_files(dir_path, files, item_id, new_names):
+    for old_name in files.get(item_id, []):
+        if old_name not in new_names and (dir_path / old_name).exists():
+            (dir_path / old_name).unlink()
+    files[item_id] = new_names
+
+def pull_directory(dir_path, wp_api, format="markdown", include_media=True, download_media=True,
+                   reconcile_every=10, reconcile=None):
+    # Incremental remote -> local mirror. Only posts / media modified since the last pull are
+    # requested (modified_after); posts are written as frontmatter markdown (the format
+    # sync_markdown_directory reads) or JSON, media as JSON metadata plus the file under media/.
+    # Deletions are found by comparing the remote id set every reconcile_every runs.
+    dir_path = Path(dir_path)
+    media_path = dir_path / "media"
+    dir_path.mkdir(parents=True, exist_ok=True)
+    state_path = dir_path / PULL_STATE_NAME
+    state = load_json(state_path, default={"runs": 0, "posts": {"files": {}}, "media": {"files": {}}})
+    state["runs"] += 1
+    if reconcile is None:
+        reconcile = state["runs"] % reconcile_every == 0
+    metrics = wp_api.metrics
+    stats = {"posts": 0, "media": 0, "deleted": 0}
+
+    with metrics.timer("pull.posts"):
+        files = state["posts"]["files"]
+        for post_data in _changed_since(wp_api, "wp/v2/posts", POST_STATUSES, state["posts"]):
+            if format == "json":
+                name = f"{post_data['slug']}.json"
+                dump_json(dir_path / name, post_data)
+            else:
+                name = f"{post_data['slug']}.md"
+                (dir_path / name).write_text(_post_frontmatter(wp_api, post_data))
+            _replace_files(dir_path, files, str(post_data["id"]), [name])
+            stats["posts"] += 1
+
+    if include_media:
+        media_path.mkdir(exist_ok=True)
+        with metrics.timer("pull.media"):
+            files = state["media"]["files"]
+            for media_data in _changed_since(wp_api, "wp/v2/media", MEDIA_STATUSES, state["media"]):
+                names = [f"{media_data['slug']}.json"]
+                dump_json(media_path / names[0], media_data)
+                if download_media:
+                    media = WordPressMedia(media_path, media_data, wp_api=wp_api)
+                    media.download(replace_existing=True)
+                    names.append(media.path.name)
+                _replace_files(media_path, files, str(media_data["id"]), names)
+                stats["media"] += 1
+
+    if reconcile:
+        with metrics.timer("pull.reconcile"):
+            kinds = [("posts", "wp/v2/posts", POST_STATUSES, dir_path)]
+            if include_media:
+                kinds.append(("media", "wp/v2/media", MEDIA_STATUSES, media_path))
+            for (kind, endpoint, statuses, path) in kinds:
+                remote_ids = set(str(item["id"]) for item in
+                                 wp_api.paged(endpoint, status=",".join(statuses), fields=["id"]))
+                files = state[kind]["files"]
+                for item_id in [item_id for item_id in files if item_id not in remote_ids]:
+                    _replace_files(path, files, item_id, [])
+                    del files[item_id]
+                    stats["deleted"] += 1
+
+    dump_json(state_path, state)
+    return stats
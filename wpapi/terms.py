@@ -0,0 +1,121 @@
+import threading
+import time
+
+class TermIndex:
+    # lazily-loaded index of a taxonomy (categories, tags, ...) with case-insensitive name and slug
+    # lookups; created terms are added in place, so resolution only hits the network once
+    def __init__(self, wp_api, endpoint, label="Terms", ttl=None):
+        self.wp_api = wp_api
+        self.endpoint = endpoint
+        self.label = label
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._terms = None
+            self._by_name = {}
+            self._by_slug = {}
+            self._loaded_at = None
+
+    @property
+    def stale(self):
+        if self._terms is None:
+            return True
+        return self.ttl is not None and time.monotonic() - self._loaded_at > self.ttl
+
+    def load(self):
+        terms = list(self.wp_api.paged(self.endpoint))
+        with self._lock:
+            self._terms, self._by_name, self._by_slug = {}, {}, {}
+            for term in terms:
+                self.add(term)
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self.stale:
+            with self._lock:
+                if self.stale:
+                    self.load()
+
+    def add(self, term):
+        with self._lock:
+            if self._terms is None:
+                # not loaded (or invalidated): the next load picks the term up
+                return
+            self._terms[term["id"]] = (term["name"], term["slug"], term.get("description", ""))
+            self._by_name[term["name"].lower()] = term["id"]
+            self._by_slug[term["slug"].lower()] = term["id"]
+
+    @property
+    def terms(self):
+        self._ensure_loaded()
+        return dict(self._terms)
+
+    def get(self, name):
+        self._ensure_loaded()
+        key = name.lower()
+        return self._by_name.get(key, self._by_slug.get(key))
+
+    def name(self, term_id):
+        # the name of a loaded term, or None
+        self._ensure_loaded()
+        term = self._terms.get(term_id)
+        return None if term is None else term[0]
+
+    def names(self, term_ids):
+        # term ids -> names, reloading once if any are unknown (created since the load); ids still
+        # unknown (e.g. not visible to this user) are left out
+        self._ensure_loaded()
+        if any(term_id not in self._terms for term_id in term_ids):
+            with self._lock:
+                self.load()
+        terms = self._terms
+        return [terms[term_id][0] for term_id in term_ids if term_id in terms]
+
+    def create(self, name, fields=None):
+        term = self.wp_api.post(self.endpoint, json=dict(fields or {}, name=name))
+        self.add(term)
+        return term["id"]
+
+    def ids(self, names, create_if_missing=False):
+        self._ensure_loaded()
+        term_ids = set()
+        missing = set()
+        for name in names:
+            term_id = self.get(name)
+            if term_id is None:
+                missing.add(name)
+            else:
+                term_ids.add(term_id)
+        if missing:
+            if not create_if_missing:
+                raise ValueError(f"{self.label} not found: {missing!r}")
+            term_ids.update(self.create_many(missing))
+        return term_ids
+
+    def create_many(self, names, fields=None):
+        # one batch/v1 round trip for all the new terms; fields maps a name to more of its body
+        # (description, parent, ...)
+        names = list(names)
+        fields = fields or {}
+        if len(names) == 1:
+            return [self.create(names[0], fields.get(names[0]))]
+        with self.wp_api.batch() as batch:
+            items = [batch.post(self.endpoint, json=dict(fields.get(name, {}), name=name), callback=self.add)
+                     for name in names]
+        term_ids = []
+        errors = {}
+        for name, item in zip(names, items):
+            if item.ok:
+                term_ids.append(item.result["id"])
+            elif item.error.get("code") == "term_exists":
+                # created concurrently elsewhere since we loaded the index
+                term_ids.append(item.error["data"]["term_id"])
+                self.invalidate()
+            else:
+                errors[name] = item.error
+        if errors:
+            raise RuntimeError(f"Failed to create {self.label.lower()}: {errors!r}")
+        return term_ids
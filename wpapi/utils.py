@@ -1,15 +1,29 @@
 import base64
+import json
+import os
+import threading
+import time
 from urllib.parse import urlparse, urlunparse, urlencode, parse_qsl
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import mimetypes
 
 import requests
 from tqdm.auto import tqdm
 
-__all__ = ["UNDEFINED", "WP_DATETIME_FMT", "to_datetime", "from_datetime", "url"]
+__all__ = ["UNDEFINED", "WP_DATETIME_FMT", "to_datetime", "from_datetime", "url", "load_json", "dump_json"]
 
 UNDEFINED = object()
+
+# not in every platform's mime.types
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+mimetypes.add_type("image/heic", ".heic")
+mimetypes.add_type("video/webm", ".webm")
+mimetypes.add_type("font/woff2", ".woff2")
 WP_DATETIME_FMT = "%Y-%m-%dT%H:%M:%S"
 
 def to_datetime(dt):
@@ -29,13 +43,136 @@ def url(base_url,  **params):
     new_parsed = parsed._replace(query=urlencode(existing_params))
     return urlunparse(new_parsed)
 
+class LazyData(dict):
+    # a record fetched with a _fields projection; the first access to a field outside the
+    # projection calls loader() once for the full object and fills in the missing keys
+    def __init__(self, data, loader):
+        super().__init__(data)
+        self._loader = loader
+
+    @property
+    def hydrated(self):
+        return self._loader is None
+
+    def hydrate(self):
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            for key, value in loader().items():
+                self.setdefault(key, value)
+        return self
+
+    def __missing__(self, key):
+        if self._loader is None:
+            raise KeyError(key)
+        self.hydrate()
+        return self[key]
+
+    def __contains__(self, key):
+        if not super().__contains__(key) and self._loader is not None:
+            self.hydrate()
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+def retry_after(value):
+    # seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    # thread-safe client-side rate limiter: rate tokens per second, holding at most burst
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = max(1.0, rate if burst is None else burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def guess_mime_type(path, default="application/octet-stream"):
+    mime_type, _ = mimetypes.guess_type(str(path), strict=False)
+    return mime_type or default
+
+class ProgressReader:
+    # wraps a binary file so requests streams it as a body while reporting progress(bytes_read, total)
+    def __init__(self, fp, callback, total=None):
+        self.fp = fp
+        self.callback = callback
+        if total is None:
+            total = os.fstat(fp.fileno()).st_size - fp.tell()
+        self.total = total
+        self.bytes_read = 0
+
+    def __len__(self):
+        return self.total - self.bytes_read
+
+    def tell(self):
+        return self.bytes_read
+
+    def seek(self, offset):
+        # only used to rewind for a retry
+        self.fp.seek(self.fp.tell() - self.bytes_read + offset)
+        self.bytes_read = offset
+
+    def read(self, size=-1):
+        chunk = self.fp.read(size)
+        self.bytes_read += len(chunk)
+        self.callback(self.bytes_read, self.total)
+        return chunk
+
 def is_dir(path):
     if isinstance(path, str) and path.endswith("/"):
         return True
     return Path(path).is_dir()
 
+_default_session = None
+
+def default_session():
+    # shared pooled session for downloads made without an API session
+    global _default_session
+    if _default_session is None:
+        _default_session = requests.Session()
+    return _default_session
+
+def _validator(headers):
+    # a strong ETag or Last-Modified to send as If-Range, so a resumed download can't splice two versions
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+class _RemoteChanged(RuntimeError):
+    pass
+
 def download_file(url, download_to=None, progress=False, exists_ok=True,
-                  overwrite=False, ok_errs=None, chunk_size=8192, max_size=None):
+                  overwrite=False, ok_errs=None, chunk_size=1 << 20, max_size=None,
+                  session=None, resume=True, max_workers=4, parallel_min_size=64 << 20, part_size=16 << 20):
+    # Downloads into a hidden .<file>.part and renames when complete. With resume, an existing .part
+    # is continued with a Range request instead of starting over, guarded by If-Range with the
+    # ETag / Last-Modified recorded in .<file>.part.json, so a file changed remotely is fetched afresh.
+    # Files of at least parallel_min_size from servers that accept ranges are fetched as part_size
+    # ranges by max_workers threads into a preallocated file; finished ranges are listed in the
+    # .part.json too, so those resume as well.
     name = url.split("/")[-1]
     if download_to is None:
         download_to = name
@@ -46,26 +183,118 @@ def download_file(url, download_to=None, progress=False, exists_ok=True,
     assert exists_ok or not already_exists, "File already exists"
     if already_exists and not overwrite:
         return download_path
-    with requests.get(url, stream=True) as r:
+    session = default_session() if session is None else session
+    part_path = download_path.with_name(f".{download_path.name}.part")
+    state_path = download_path.with_name(f".{download_path.name}.part.json")
+    state = load_json(state_path) if resume else None
+    if state is None or not part_path.exists():
+        # a .part without a validator to check it against can't be trusted
+        state = None
+        for path in (part_path, state_path):
+            if path.exists():
+                path.unlink()
+    if state is not None and "done" in state:
+        try:
+            _download_ranges(url, part_path, state_path, state, session, progress, name, chunk_size, max_workers)
+        except _RemoteChanged:
+            state = None
+            part_path.unlink()
+            state_path.unlink()
+        else:
+            os.replace(part_path, download_path)
+            state_path.unlink()
+            return download_path
+    offset = part_path.stat().st_size if state is not None else 0
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = state["validator"]
+    with session.get(url, stream=True, headers=headers) as r:
         if ok_errs and r.status_code in ok_errs:
             return None
+        if offset and r.status_code == 416:
+            # the .part file already holds everything
+            os.replace(part_path, download_path)
+            state_path.unlink()
+            return download_path
         r.raise_for_status()
-        total_size = int(r.headers.get("content-length", 0))
+        if offset and r.status_code != 206:
+            offset = 0  # range ignored, or the file changed since the .part was started; start over
+        total_size = offset + int(r.headers.get("content-length", 0))
         if max_size is not None and total_size > max_size:
             raise RuntimeError(f"File at {url!r} larger than max size: {total_size} > {max_size}")
-        with tqdm(total=total_size, unit="iB", unit_scale=True,
+        validator = _validator(r.headers)
+        if (offset == 0 and max_workers > 1 and total_size >= parallel_min_size
+                and r.headers.get("accept-ranges") == "bytes" and validator is not None):
+            r.close()
+            state = {"validator": validator, "size": total_size, "part_size": part_size, "done": []}
+            with part_path.open(mode="wb") as f:
+                f.truncate(total_size)
+            dump_json(state_path, state)
+            _download_ranges(url, part_path, state_path, state, session, progress, name, chunk_size, max_workers)
+            os.replace(part_path, download_path)
+            state_path.unlink()
+            return download_path
+        if offset == 0:
+            if resume and validator is not None:
+                dump_json(state_path, {"validator": validator})
+            elif state_path.exists():
+                state_path.unlink()
+        with tqdm(total=total_size, initial=offset, unit="iB", unit_scale=True,
             disable=not progress, desc=f"download {name}", leave=False) as pbar:
             try:
-                with download_path.open(mode="wb") as f:
+                with part_path.open(mode="ab" if offset else "wb") as f:
                     for chunk in r.iter_content(chunk_size=chunk_size):
                         if chunk:  # filter out keep-alive new chunks
                             pbar.update(len(chunk))
                             f.write(chunk)
             except:
-                download_path.unlink()
+                if not resume:
+                    part_path.unlink()
                 raise
+    os.replace(part_path, download_path)
+    if state_path.exists():
+        state_path.unlink()
     return download_path
 
+def _download_ranges(url, part_path, state_path, state, session, progress, name, chunk_size, max_workers):
+    total_size, part_size = state["size"], state["part_size"]
+    done = set(state["done"])
+    todo = [start for start in range(0, total_size, part_size) if start not in done]
+    lock = threading.Lock()
+    with tqdm(total=total_size, initial=len(done) * part_size, unit="iB", unit_scale=True,
+        disable=not progress, desc=f"download {name}", leave=False) as pbar:
+        def fetch(start):
+            end = min(start + part_size, total_size) - 1
+            headers = {"Range": f"bytes={start}-{end}", "If-Range": state["validator"], "Accept-Encoding": "identity"}
+            with session.get(url, stream=True, headers=headers) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    if _validator(r.headers) != state["validator"]:
+                        raise _RemoteChanged(url)
+                    raise RuntimeError(f"Server ignored range request for {url!r}")
+                with part_path.open(mode="r+b") as f:
+                    f.seek(start)
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            pbar.update(len(chunk))
+            with lock:
+                done.add(start)
+                dump_json(state_path, dict(state, done=sorted(done)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in [executor.submit(fetch, start) for start in todo]:
+                future.result()
+
+def stream_hash(url, algo="sha1", session=None, chunk_size=65536):
+    # hashes a remote file as it streams in; nothing is written to disk
+    h = hashlib.new(algo)
+    with (session or default_session()).get(url, stream=True) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
 def filehash(path, algo="sha1", buf_size=65536):
     h = hashlib.new(algo)
     with open(path, mode="rb") as fp:
@@ -75,3 +304,19 @@ def filehash(path, algo="sha1", buf_size=65536):
                 break
             h.update(data)
     return h.hexdigest()
+
+
+def load_json(path, default=None):
+    path = Path(path)
+    if not path.exists():
+        return default
+    with path.open() as fp:
+        return json.load(fp)
+
+def dump_json(path, obj):
+    # write to a sibling temp file and rename, so an interrupted run never leaves a truncated file
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with tmp_path.open(mode="w") as fp:
+        json.dump(obj, fp, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)